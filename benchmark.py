@@ -0,0 +1,607 @@
+""" Benchmarks the crawler and the downloader of pb_shovel against a local
+    stand-in for Photobucket, so the numbers don't depend on the live site.
+
+    The stand-in serves synthetic album pages (with 'albumJson',
+    'collectionData', the token input and the guest login form), private
+    albums behind the account login, media pages, the sub-album API and media
+    bodies of a configurable size after a configurable latency. pb_shovel
+    reaches it as its HTTP proxy, the login is posted over HTTP instead of
+    HTTPS.
+
+    python benchmark.py                 Runs all scenarios and compares the
+                                        results with benchmark_baseline.json
+    python benchmark.py --save          Records the results as new baseline
+    python benchmark.py image_parse     Runs only the passed scenarios
+
+    Each scenario runs a few rounds and the best result of each measurement
+    counts. The default latency keeps the crawl and download scenarios waiting
+    for the server, so they don't depend on the speed of the machine. A
+    baseline only holds for the settings it was recorded with, the results of
+    other settings aren't compared with it. The CPU-bound scenarios are
+    compared relative to the speed of the machine, which is measured with a
+    fixed Python loop before and after they run. """
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+import requests
+
+import pb_shovel
+
+# The stand-in can't serve HTTPS
+pb_shovel.LOGIN_URL = pb_shovel.LOGIN_URL.replace("https://", "http://")
+
+BASELINE_FNAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "benchmark_baseline.json")
+HOME_URL = "http://photobucket.com/"
+PAGES_HOST = "http://s1.photobucket.com"
+MEDIA_HOST = "http://i1.photobucket.com"
+
+
+class MockPhotobucket(ThreadingMixIn, HTTPServer):
+    """ A local HTTP server which answers the requests pb_shovel makes to
+        Photobucket. It is meant to be used as HTTP proxy, so the requests
+        carry the full URL of the original host. Albums are added with
+        add_album, their media is generated from the album and the index. """
+    daemon_threads = True
+    PAGE_SIZE = 24
+
+    def __init__(self, latency=0.0, media_size=64 * 1024):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), MockHandler)
+        self.latency = latency
+        self.media_size = media_size
+        self.albums = {}
+        # The passwords of the accounts and the owners of the auth cookies
+        self.accounts = {}
+        self.sessions = {}
+        self.hits = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def proxy(self):
+        return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+    def add_album(self, user, location="", items=0, password=None, private=False):
+        """ Adds an album, location is the path of the album below the bucket
+            of the user, '' is the bucket itself. A private album is only shown
+            to the logged in user. Returns the link to it. """
+        self.albums[(user, location)] = {"items": items, "password": password,
+                                         "private": private}
+        return "{0}/user/{1}/library/{2}".format(PAGES_HOST, user, location)
+
+    def add_account(self, user, password):
+        """ Adds an account which can log in with the passed password. """
+        self.accounts[user] = password
+
+    def logged_in_user(self, cookies):
+        """ Returns the user of the auth cookie in the passed Cookie header. """
+        for cookie in cookies.split(";"):
+            name, _, value = cookie.strip().partition("=")
+            if name == "pbauth":
+                return self.sessions.get(value)
+
+    def sub_albums(self, user, location):
+        """ Returns the locations of the direct sub-albums of an album. """
+        prefix = location + "/" if location else ""
+        return sorted(loc for u, loc in self.albums if u == user and loc
+                      and loc.startswith(prefix) and "/" not in loc[len(prefix):])
+
+    def count(self, name):
+        with self._lock:
+            self.hits[name] = self.hits.get(name, 0) + 1
+
+    def media_object(self, user, location, index):
+        """ Returns the JSON description of a media file. """
+        name = "{0}_{1}.jpg".format(location.replace("/", "_") or "root", index)
+        link = "{0}/albums/x/{1}/{2}/{3}".format(MEDIA_HOST, user, location, name)
+        return {"name": name, "title": name, "username": user,
+                "mediaType": "video" if index % 10 == 9 else "image",
+                "fullsizeUrl": link, "originalUrl": link + "~original",
+                "likeCount": index % 7, "commentCount": index % 3,
+                "viewCount": index * 13}
+
+    def album_page(self, user, location, page):
+        """ Returns the source of a page of an album. """
+        album = self.albums[(user, location)]
+        first = (page - 1) * self.PAGE_SIZE
+        objects = [self.media_object(user, location, i) for i in
+                   range(first, min(album["items"], first + self.PAGE_SIZE))]
+        album_json = {"ownername": user, "isRootAlbum": not location,
+                      "location": location,
+                      "albumStats": {"images": {"count": album["items"]},
+                                     "videos": {"count": 0},
+                                     "subalbums": {"count": len(self.sub_albums(user, location))}}}
+        collection_data = {"items": {"objects": objects}, "pageNumber": page}
+        return ("<html><head><title>{0}</title></head><body>\n"
+                "<input type=\"hidden\" id=\"token\" value=\"{1}\"/>\n"
+                "<script type=\"text/javascript\">\n"
+                "    var albumJson = {2};\n"
+                "</script>\n<div id=\"album\">{3}</div>\n"
+                "<script type=\"text/javascript\">\n"
+                "    new Pb.Collection({{\n"
+                "        collectionId: 'libraryAlbums',\n"
+                "        collectionData: {4},\n"
+                "    }});\n"
+                "</script></body></html>").format(
+                    location or user, self.token(user), json.dumps(album_json),
+                    "<div class=\"thumb\"></div>" * len(objects), json.dumps(collection_data))
+
+    def guest_page(self, user, location):
+        """ Returns the source of a guest password protected album. """
+        return ("<html><body>\n<p>This album is Password-Protected.</p>\n"
+                "<input type=\"hidden\" id=\"token\" value=\"{0}\"/>\n"
+                "<form id=\"guestLoginForm\" action=\"/action/album/login\" method=\"post\">\n"
+                "<input type=\"hidden\" name=\"albumPath\" value=\"/albums/x/{1}/{2}\"/>\n"
+                "<input type=\"hidden\" name=\"albumType\" value=\"album\"/>\n"
+                "<input type=\"hidden\" name=\"albumView\" value=\"library\"/>\n"
+                "<input type=\"password\" name=\"visitorPassword\"/>\n"
+                "</form></body></html>").format(self.token(user), user, location)
+
+    def home_page(self, user=None):
+        """ Returns the source of the home page, with the login form unless a
+            user is logged in. """
+        if user:
+            account = "<a href=\"/user/{0}/library/\">{0}</a>".format(user)
+        else:
+            account = ("<form id=\"loginForm\" action=\"{0}\" method=\"post\">"
+                       "</form>").format(pb_shovel.LOGIN_URL)
+        return ("<html><body>\n<input type=\"hidden\" id=\"token\" value=\"{0}\"/>\n"
+                "{1}\n</body></html>").format(self.token("home"), account)
+
+    def private_page(self):
+        """ Returns the source of a private album for other users. """
+        return "<html><body>\n<p>This album is Private.</p>\n</body></html>"
+
+    def media_page(self, user, location, index):
+        """ Returns the source of the page of a single media file. """
+        return ("<html><body>\n<input type=\"hidden\" id=\"token\" value=\"{0}\"/>\n"
+                "<script type=\"text/javascript\">\n"
+                "    Pb.Data.Shared.put(Pb.Data.Shared.MEDIA, {1});\n"
+                "</script></body></html>").format(
+                    self.token(user), json.dumps(self.media_object(user, location, index)))
+
+    def token(self, user):
+        return hashlib.md5(user).hexdigest()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """ Answers a request to the MockPhotobucket. The connections are kept
+        alive, so the response is buffered and sent without waiting for Nagle's
+        algorithm, which would otherwise hold back each response on a reused
+        connection until the client's delayed ACK. """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body="", content_type="text/html", headers=()):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _split(self, path, prefix):
+        """ Returns the user and the rest of a path which starts with prefix. """
+        user, _, rest = path[len(prefix):].partition("/")
+        return user, rest
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        up = urlparse(self.path)
+        query = parse_qs(up.query, keep_blank_values=True)
+        if up.path.startswith("/albums/"):
+            server.count("media")
+            body = (up.path * (server.media_size // len(up.path) + 1))[:server.media_size]
+            return self._send(200, body, "image/jpeg")
+        if up.path.startswith("/api/user/"):
+            server.count("api")
+            user, rest = self._split(up.path, "/api/user/")
+            location = rest[len("album/"):-len("get")].strip("/")
+            sub_albums = [{"url": "{0}/user/{1}/library/{2}".format(PAGES_HOST, user, loc)}
+                          for loc in server.sub_albums(user, location)]
+            body = json.dumps({"data": {"subAlbumCount": len(sub_albums),
+                                        "subAlbums": sub_albums}})
+            return self._send(200, body, "application/json")
+        if self.path == HOME_URL:
+            server.count("home")
+            user = server.logged_in_user(self.headers.get("Cookie", ""))
+            return self._send(200, server.home_page(user))
+        if not up.path.startswith("/user/"):
+            return self._send(404, "Sorry, the requested page does not exist.")
+        user, rest = self._split(up.path, "/user/")
+        if rest.startswith("media/"):
+            server.count("media pages")
+            location, _, name = rest[len("media/"):].rpartition("/")
+            index = int(name.rsplit("_", 1)[-1].split(".")[0])
+            return self._send(200, server.media_page(user, location, index))
+        if rest.startswith("library"):
+            location = rest[len("library"):].strip("/")
+            album = server.albums.get((user, location))
+            if album is None:
+                return self._send(404, "Sorry, the requested page does not exist.")
+            server.count("pages")
+            if album["private"] and server.logged_in_user(
+                                    self.headers.get("Cookie", "")) != user:
+                return self._send(200, server.private_page())
+            if album["password"] and "guest_{0}".format(user) not in self.headers.get("Cookie", ""):
+                return self._send(200, server.guest_page(user, location))
+            page = int((query.get("page") or ["1"])[0] or 1)
+            pages = max(1, -(-album["items"] // server.PAGE_SIZE))
+            if "page" in query and page > pages:
+                # Photobucket redirects to the album when a page is out of range
+                location_header = "{0}{1}".format(PAGES_HOST, up.path)
+                return self._send(302, headers=[("Location", location_header)])
+            return self._send(200, server.album_page(user, location, page))
+        self._send(404, "Sorry, the requested page does not exist.")
+
+    def do_POST(self):
+        server = self.server
+        time.sleep(server.latency)
+        up = urlparse(self.path)
+        form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+        if up.path == urlparse(pb_shovel.LOGIN_URL).path:
+            server.count("account logins")
+            user = form.get("username", [""])[0]
+            if user not in server.accounts or\
+               form.get("password", [""])[0] != server.accounts[user]:
+                return self._send(200, server.home_page())
+            cookie = hashlib.md5("{0}{1}".format(user, len(server.sessions))).hexdigest()
+            server.sessions[cookie] = user
+            return self._send(200, server.home_page(user), headers=[
+                ("Set-Cookie", "pbauth={0}; Domain=.photobucket.com; Path=/".format(cookie))])
+        if up.path == "/action/album/login":
+            server.count("logins")
+            user, location = form["albumPath"][0].split("/", 4)[3:]
+            album = server.albums.get((user, location))
+            if not album or form.get("visitorPassword", [""])[0] != album["password"]:
+                return self._send(200, "Password is incorrect.")
+            return self._send(200, server.album_page(user, location, 1),
+                              headers=[("Set-Cookie", "guest_{0}=1; Path=/".format(user))])
+        self._send(404, "Sorry, the requested page does not exist.")
+
+
+@contextlib.contextmanager
+def quiet():
+    """ Silences the progress output of pb_shovel. """
+    with open(os.devnull, "w") as devnull:
+        stderr, stdout = pb_shovel.stderr, sys.stdout
+        pb_shovel.stderr = sys.stdout = devnull
+        try:
+            yield
+        finally:
+            pb_shovel.stderr, sys.stdout = stderr, stdout
+
+
+def create_shovel(server, urls, jobs, *extra):
+    """ Returns a Photobucket instance which talks to the passed server, the
+        arguments are the ones of the command line. """
+    output = tempfile.mkdtemp(prefix="pb_bench_")
+    args = pb_shovel.build_parser().parse_args(["-u"] + urls + ["-o", output, "-j",
+                                                str(jobs)] + list(extra))
+    # The session has to use the server from the start, a login already
+    # happens while the instance is created
+    session = requests.session()
+    session.trust_env = False
+    session.proxies = {"http": server.proxy}
+    create_session = pb_shovel.requests.session
+    pb_shovel.requests.session = lambda: session
+    try:
+        with quiet():
+            pb = pb_shovel.Photobucket(args)
+    finally:
+        pb_shovel.requests.session = create_session
+    return pb, output
+
+
+def finish(pb, output):
+    """ Releases the Photobucket instance and removes its output directory. """
+    with quiet():
+        pb.close()
+    # Close the kept alive connections before the server goes away
+    pb._session.close()
+    shutil.rmtree(output)
+
+
+def calibrate():
+    """ Returns how many iterations of a fixed Python loop the machine runs per
+        second, the best of three rounds. """
+    best = 0
+    for _ in range(3):
+        start = time.time()
+        total = 0
+        for i in xrange(1000000):
+            total += i % 7
+        best = max(best, 1000000 / (time.time() - start))
+    return best
+
+
+def bench_image_parse(options):
+    """ Parses single media pages. """
+    server = MockPhotobucket()
+    sources = [pb_shovel.Page(server.media_page("bench", "album", i)) for i in range(5000)]
+    pb, output = create_shovel(server, ["http://photobucket.com/"], 1)
+    start = time.time()
+    for source in sources:
+        assert pb._image(source)
+    elapsed = time.time() - start
+    finish(pb, output)
+    return {"pages_per_second": len(sources) / elapsed}
+
+
+def bench_extract_album(options):
+    """ Extracts a single album with many pages. """
+    server = MockPhotobucket(options.latency).start()
+    try:
+        link = server.add_album("bench", "large", items=100 * MockPhotobucket.PAGE_SIZE)
+        pb, output = create_shovel(server, [link], options.jobs)
+        start = time.time()
+        with quiet():
+            collected = pb.extract()
+        elapsed = time.time() - start
+        finish(pb, output)
+    finally:
+        server.stop()
+    assert len(collected) == 100 * MockPhotobucket.PAGE_SIZE, len(collected)
+    return {"pages_per_second": server.hits["pages"] / elapsed,
+            "items_per_second": len(collected) / elapsed}
+
+
+def bench_extract_recursive(options):
+    """ Extracts a bucket with a tree of sub-albums recursively. """
+    server = MockPhotobucket(options.latency).start()
+    try:
+        link = server.add_album("tree", "", items=10)
+        for a in range(4):
+            server.add_album("tree", "a{0}".format(a), items=60)
+            for b in range(3):
+                server.add_album("tree", "a{0}/b{1}".format(a, b), items=60)
+                for c in range(2):
+                    server.add_album("tree", "a{0}/b{1}/c{2}".format(a, b, c), items=30)
+        pb, output = create_shovel(server, [link], options.jobs, "-r")
+        start = time.time()
+        with quiet():
+            collected = pb.extract()
+        elapsed = time.time() - start
+        finish(pb, output)
+    finally:
+        server.stop()
+    albums = len(server.albums)
+    assert len(collected) == 10 + 4 * 60 + 12 * 60 + 24 * 30, len(collected)
+    return {"albums_per_second": albums / elapsed,
+            "pages_per_second": server.hits["pages"] / elapsed}
+
+
+def bench_extract_guest_album(options):
+    """ Enters the guest password of an album and extracts it. """
+    server = MockPhotobucket(options.latency).start()
+    try:
+        link = server.add_album("guest", "secret", items=40 * MockPhotobucket.PAGE_SIZE,
+                                password="hunter2")
+        pb, output = create_shovel(server, ["hunter2@" + link], options.jobs)
+        start = time.time()
+        with quiet():
+            collected = pb.extract()
+        elapsed = time.time() - start
+        finish(pb, output)
+    finally:
+        server.stop()
+    assert len(collected) == 40 * MockPhotobucket.PAGE_SIZE, len(collected)
+    return {"pages_per_second": server.hits["pages"] / elapsed}
+
+
+def bench_extract_private_album(options):
+    """ Logs in with an account and extracts a private album of it, three
+        times with a --session-file: the first run logs in, the second one
+        reuses the stored session and the third one has to log in again after
+        the server dropped the session. """
+    server = MockPhotobucket(options.latency).start()
+    session_file = tempfile.mktemp(prefix="pb_bench_", suffix=".json")
+    try:
+        server.add_account("owner", "hunter2")
+        link = server.add_album("owner", "private", items=40 * MockPhotobucket.PAGE_SIZE,
+                                private=True)
+        start = time.time()
+        for logins, drop_sessions in ((1, False), (1, True), (2, False)):
+            pb, output = create_shovel(server, [link], options.jobs, "-n", "owner",
+                                       "-p", "hunter2", "--session-file", session_file)
+            with quiet():
+                collected = pb.extract()
+            finish(pb, output)
+            assert server.hits["account logins"] == logins, server.hits
+            assert len(collected) == 40 * MockPhotobucket.PAGE_SIZE, len(collected)
+            if drop_sessions:
+                server.sessions.clear()
+        elapsed = time.time() - start
+    finally:
+        server.stop()
+        if os.path.isfile(session_file):
+            os.remove(session_file)
+    return {"pages_per_second": server.hits["pages"] / elapsed}
+
+
+def bench_download_all_images(options):
+    """ Downloads the media of an album. """
+    server = MockPhotobucket(options.latency, options.media_size * 1024).start()
+    try:
+        link = server.add_album("media", "files", items=options.files)
+        pb, output = create_shovel(server, [link], options.jobs)
+        with quiet():
+            pb.extract()
+            start = time.time()
+            pb.download_all_images()
+            elapsed = time.time() - start
+        downloaded = len(os.listdir(output))
+        size = sum(os.path.getsize(os.path.join(output, name))
+                   for name in os.listdir(output))
+        finish(pb, output)
+    finally:
+        server.stop()
+    assert downloaded == options.files, downloaded
+    return {"files_per_second": downloaded / elapsed,
+            "megabytes_per_second": size / (1024.0 * 1024.0) / elapsed}
+
+
+SCENARIOS = [("image_parse", bench_image_parse),
+             ("extract_album", bench_extract_album),
+             ("extract_recursive", bench_extract_recursive),
+             ("extract_guest_album", bench_extract_guest_album),
+             ("extract_private_album", bench_extract_private_album),
+             ("download_all_images", bench_download_all_images)]
+# The scenarios which don't wait for the server, their results depend on the
+# speed of the machine
+CPU_SCENARIOS = ("image_parse",)
+
+
+def compare(results, baseline, tolerance, speedup=1.0):
+    """ Prints the results next to the baseline and returns the names of the
+        measurements which fell more than tolerance below their baseline. All
+        measurements are rates, higher is better. The baseline of the CPU-bound
+        scenarios is scaled by the passed speedup of the machine. """
+    regressions = []
+    print("{0:<42}{1:>12}{2:>12}{3:>9}".format("Measurement", "Result", "Baseline", "Change"))
+    for scenario, _ in SCENARIOS:
+        for name, value in sorted(results.get(scenario, {}).items()):
+            key = "{0}.{1}".format(scenario, name)
+            base = baseline.get(scenario, {}).get(name)
+            if base and scenario in CPU_SCENARIOS:
+                base *= speedup
+            if base:
+                change = (value - base) / base
+                if change < -tolerance:
+                    regressions.append(key)
+                print("{0:<42}{1:>12.1f}{2:>12.1f}{3:>+8.0%}{4}".format(
+                      key, value, base, change, " !" if change < -tolerance else ""))
+            else:
+                print("{0:<42}{1:>12.1f}{2:>12}".format(key, value, "-"))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks pb_shovel against a"+\
+                                     " local stand-in for Photobucket.")
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO",
+                        help="The scenarios to run: {0}. (default: all)".format(
+                             ", ".join(name for name, _ in SCENARIOS)))
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="The -j/--jobs of pb_shovel. (default: 4)")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="The seconds the server waits before each response,"+\
+                             " high enough for the crawl and download scenarios"+\
+                             " to wait for the network rather than the CPU."+\
+                             " (default: 0.05)")
+    parser.add_argument("--media-size", type=int, default=256,
+                        help="The size of each media file in KiB. (default: 256)")
+    parser.add_argument("--files", type=int, default=200,
+                        help="The number of files of the download scenario."+\
+                             " (default: 200)")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="How often each scenario runs, the best result of"+\
+                             " each measurement counts. (default: 3)")
+    parser.add_argument("--baseline", default=BASELINE_FNAME,
+                        help="The file with the baseline results. (default:"+\
+                             " benchmark_baseline.json)")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="How far below the baseline a result may fall before"+\
+                             " it counts as regression. (default: 0.25)")
+    parser.add_argument("--save", action="store_true",
+                        help="Write the results to the baseline file.")
+    args = parser.parse_args()
+
+    names = args.scenarios or [name for name, _ in SCENARIOS]
+    unknown = set(names) - set(name for name, _ in SCENARIOS)
+    if unknown:
+        sys.stderr.write("Unknown scenarios: {0}\n".format(", ".join(sorted(unknown))))
+        exit(1)
+
+    settings = {"jobs": args.jobs, "latency": args.latency,
+                "media_size": args.media_size, "files": args.files}
+    saved = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+    differing = sorted(key for key, value in saved.get("settings", {}).items()
+                       if settings.get(key) != value)
+    if differing:
+        if not args.save:
+            sys.stderr.write("The baseline has been recorded with other settings"
+                             " ({0}), pass the same settings, another --baseline or"
+                             " --save.\n".format(", ".join(
+                             "{0}={1}".format(key, saved["settings"][key])
+                             for key in differing)))
+            exit(1)
+        # Start over, the results of other settings can't be mixed
+        saved = {}
+    baseline = saved.get("results", {})
+
+    results = {}
+    calibration = None
+    for name, scenario in SCENARIOS:
+        if name in names:
+            sys.stderr.write("Running {0}\n".format(name))
+            if name in CPU_SCENARIOS:
+                # The speed of a virtual machine drifts, measure it right before
+                # and after the scenario and keep the faster one
+                speed = calibrate()
+            best = {}
+            for _ in range(max(1, args.rounds)):
+                for key, value in scenario(args).items():
+                    best[key] = max(best.get(key, 0), value)
+            results[name] = best
+            if name in CPU_SCENARIOS:
+                calibration = max(calibration, speed, calibrate())
+    speedup = 1.0
+    if calibration and saved.get("calibration"):
+        speedup = calibration / saved["calibration"]
+    calibration = calibration or saved.get("calibration")
+
+    regressions = compare(results, baseline, args.tolerance, speedup)
+
+    if args.save:
+        if speedup != 1.0:
+            # Keep the baseline of the CPU-bound scenarios which didn't run
+            # relative to the new calibration
+            for name in CPU_SCENARIOS:
+                if name in baseline and name not in results:
+                    baseline[name] = dict((key, value * speedup)
+                                          for key, value in baseline[name].items())
+        baseline.update(results)
+        saved = {"settings": settings, "results": baseline}
+        if calibration:
+            saved["calibration"] = calibration
+        with open(args.baseline, "w") as f:
+            json.dump(saved, f, indent=2, sort_keys=True, separators=(",", ": "))
+            f.write("\n")
+    elif regressions:
+        sys.stderr.write("Regressions: {0}\n".format(", ".join(regressions)))
+        exit(1)
@@ -1,12 +1,47 @@
 import os
 import re
+import sys
+import gzip
 import json
+import time
+import uuid
+import math
+import Queue
+import random
+import socket
+import hashlib
+import struct
+import shutil
+import sqlite3
+import tarfile
+import zipfile
+import tempfile
+import cProfile
+import pstats
 import argparse
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from email.utils import parsedate_tz, mktime_tz
 from sys import stderr
+from urllib import unquote
 from urlparse import urljoin, urlparse
 from bs4 import BeautifulSoup
 import requests
+try: # Only available on Unix
+    import resource
+except ImportError:
+    resource = None
+try: # Only available on Unix
+    import fcntl
+except ImportError:
+    fcntl = None
+try: # lxml is optional, but parses a lot faster than Python's own HTML parser
+    import lxml
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
 
 #
 #   Title:  pb_shovel.py
@@ -29,19 +64,1700 @@ import requests
 
 # Name of the file that contains the links scraped in a session:
 LINKS_FNAME = 'links-' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.txt'
+# The form which the account credentials are posted to:
+LOGIN_URL = "https://secure.photobucket.com/action/auth/login"
+# The extension of the links file for the --links-format formats:
+LINKS_EXTENSIONS = {"urls": ".txt", "aria2": ".txt", "jsonl": ".jsonl"}
 
 class ImageInfo(object):
     """ Stores image information, contains the direct link to the image and
-        various other information. """
+        various other information. Large buckets keep millions of these in
+        memory, so the attributes are slotted, ASCII text is stored as byte
+        strings and the usernames, media types and album URLs are shared
+        between files. """
+    __slots__ = ("filename", "title", "_album_url", "_link", "mediaType",
+                 "likeCount", "commentCount", "viewCount", "username")
+    _shared = {}
+
     def __init__(self, filename, **kwargs):
-        self.filename = filename
-        self.title = kwargs.get("title")
+        self.filename = _compact(filename)
+        title = kwargs.get("title")
+        self.title = self.filename if title == filename else _compact(title)
         self.link = kwargs.get("originalUrl").replace("~original", "")
-        self.mediaType = kwargs.get("mediaType")
+        self.mediaType = self._share(kwargs.get("mediaType"))
         self.likeCount = kwargs.get("likeCount")
         self.commentCount = kwargs.get("commentCount")
         self.viewCount = kwargs.get("viewCount")
-        self.username = kwargs.get("username")
+        self.username = self._share(kwargs.get("username"))
+
+    @property
+    def link(self):
+        """ The direct link to the file. """
+        if self._album_url is not None:
+            return self._album_url + self.filename
+        return self._link
+
+    @link.setter
+    def link(self, link):
+        # Most links are the URL of the album followed by the file name, only
+        # the shared album URL is kept for them
+        link = _compact(link)
+        if self.filename and link.endswith(self.filename) and link != self.filename:
+            self._album_url = self._share(link[:-len(self.filename)])
+            self._link = None
+        else:
+            self._album_url = None
+            self._link = link
+
+    @property
+    def key(self):
+        """ The normalized link, two objects with the same key are the same
+            file. """
+        return _media_key(self.link)
+
+    def __eq__(self, other):
+        return isinstance(other, ImageInfo) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    @classmethod
+    def _share(cls, value):
+        """ Returns the one copy of the passed value which is used by all
+            ImageInfo objects. """
+        value = _compact(value)
+        return cls._shared.setdefault(value, value)
+
+
+def _media_key(link):
+    """ Returns the passed link to a file in a normalized form, the scheme, the
+        query, the case of the host and the escaping of the path don't matter. """
+    if isinstance(link, unicode):
+        link = link.encode("utf-8")
+    up = urlparse(link.replace("~original", ""))
+    return up.netloc.lower() + unquote(up.path)
+
+
+def _compact(value):
+    """ Returns the passed unicode string as byte string when it only contains
+        ASCII characters, which takes a fraction of the memory. """
+    if isinstance(value, unicode):
+        try:
+            return value.encode("ascii")
+        except UnicodeEncodeError:
+            pass
+    return value
+
+
+class WorkerPool(object):
+    """ Calls a function for each item put into the pool with a fixed number of
+        worker threads. The queue in front of the workers is bounded, so the
+        producer blocks instead of piling up items when the workers can't keep
+        up, which also bounds the number of requests in flight. """
+    _STOP = object()
+
+    def __init__(self, func, jobs=1):
+        self._func = func
+        self._jobs = max(1, jobs)
+        self._queue = Queue.Queue(maxsize=self._jobs * 2)
+        self._threads = []
+        self._exc_info = None
+        self.aborted = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is not None:
+            self.aborted.set()
+        self.close()
+        # Re-raise the first error of a worker (e.g. the SystemExit of a failed
+        # write) in the producer's thread, unless it is already unwinding.
+        if exc_type is None and self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    def start(self):
+        for _ in range(self._jobs):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def qsize(self):
+        """ Returns the number of queued items. """
+        return self._queue.qsize()
+
+    def put(self, item):
+        """ Queues the passed item, blocks while the queue is full. Returns False
+            when the pool has been aborted and no more items are accepted. """
+        while not self.aborted.is_set():
+            try: # Use a timeout so that a KeyboardInterrupt isn't swallowed
+                self._queue.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def close(self):
+        """ Lets the workers finish the queued items and waits for them. """
+        for _ in self._threads:
+            self._queue.put(self._STOP)
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(0.5)
+        self._threads = []
+
+    def _work(self):
+        while 1:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            if self.aborted.is_set():
+                # Drain the queue without working on the remaining items.
+                continue
+            try:
+                self._func(item)
+            except(Exception, SystemExit):
+                if not self._exc_info:
+                    self._exc_info = sys.exc_info()
+                self.aborted.set()
+
+
+class Throttle(object):
+    """ A token bucket which limits the bytes per second of all transfers which
+        share it, bursts of up to one second worth of bytes are allowed. A
+        transfer which takes more than there is left waits until the bucket has
+        refilled. A rate of 0 means no limit. """
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """ Takes the passed number of bytes from the bucket, sleeps when the
+            bucket is in debt afterwards. """
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / float(self.rate) if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class DownloadScheduler(object):
+    """ Orders the downloads by a list of policies. 'images-first' puts the
+        videos last, 'smallest' orders by the size the server reports, the
+        files with an unknown size come last. These sorting policies apply in
+        the passed order. 'round-robin' then takes turns between the albums,
+        the files of each album keep their order. 'found' keeps the order in
+        which the files were found. """
+    POLICIES = ("found", "images-first", "smallest", "round-robin")
+
+    def __init__(self, policies=()):
+        self.policies = [policy for policy in policies if policy != "found"]
+
+    @property
+    def needs_sizes(self):
+        """ Whether order needs the sizes of the files. """
+        return "smallest" in self.policies
+
+    def order(self, file_infos, sizes=None):
+        """ Returns the passed image objects in the order of the policies,
+            sizes maps the links to the sizes of the files. """
+        keys = []
+        for policy in self.policies:
+            if policy == "images-first":
+                keys.append(lambda file_info: (file_info.mediaType or "").lower() == "video")
+            elif policy == "smallest":
+                keys.append(lambda file_info: (sizes.get(file_info.link) is None,
+                                               sizes.get(file_info.link)))
+        if keys:
+            file_infos = sorted(file_infos, key=lambda file_info: [key(file_info)
+                                                                   for key in keys])
+        if "round-robin" in self.policies:
+            file_infos = self._round_robin(file_infos)
+        return file_infos
+
+    def _round_robin(self, file_infos):
+        """ Returns the passed image objects with the albums taking turns. """
+        albums = OrderedDict()
+        for file_info in file_infos:
+            albums.setdefault(file_info.link.rpartition("/")[0], deque()).append(file_info)
+        ordered = []
+        while albums:
+            for album, queue in albums.items():
+                ordered.append(queue.popleft())
+                if not queue:
+                    del albums[album]
+        return ordered
+
+
+class MediaWriter(object):
+    """ Copies streamed response bodies into files. The body is read in large
+        chunks into a buffer which is allocated once per thread and reused for
+        every chunk and file, so no new string is created for each chunk. """
+    def __init__(self, chunk_size=64 * 1024, preallocate=False, profiler=None,
+                 throttle=None):
+        self.chunk_size = chunk_size
+        self.preallocate = preallocate
+        self.profiler = profiler or Profiler()
+        self.throttle = throttle or Throttle()
+        self._local = threading.local()
+
+    def _get_buffer(self):
+        """ Returns the buffer of the current thread. """
+        buf = getattr(self._local, "buffer", None)
+        if buf is None:
+            buf = self._local.buffer = bytearray(self.chunk_size)
+        return buf
+
+    def write(self, response, f, size=None, digest=None):
+        """ Writes the body of the passed response to the passed file object and
+            returns the number of bytes written and the seconds it took. With
+            preallocation and a known size the file is extended to its final
+            size before the first write. The chunks are added to the passed
+            hashlib object as they arrive, hashlib releases the GIL while it
+            hashes, so the other downloads go on in the meantime. """
+        start = time.time()
+        position = f.tell()
+        written = 0
+        if self.preallocate and size:
+            f.truncate(position + size)
+        try:
+            raw = response.raw
+            if hasattr(raw, "readinto") and "Content-Encoding" not in response.headers:
+                buf = self._get_buffer()
+                try:
+                    while 1:
+                        count = raw.readinto(buf)
+                        if not count:
+                            break
+                        if digest:
+                            digest.update(buffer(buf, 0, count))
+                        with self.profiler.span("write"):
+                            f.write(buffer(buf, 0, count))
+                        written += count
+                        self.throttle.consume(count)
+                except(requests.packages.urllib3.exceptions.HTTPError,
+                       socket.error) as e:
+                    raise requests.exceptions.ConnectionError(e)
+            else: # Let requests decode compressed bodies
+                for chunk in response.iter_content(self.chunk_size):
+                    if chunk:
+                        if digest:
+                            digest.update(chunk)
+                        with self.profiler.span("write"):
+                            f.write(chunk)
+                        written += len(chunk)
+                        self.throttle.consume(len(chunk))
+        finally:
+            if self.preallocate and size:
+                # Cut off what wasn't written when the transfer stopped early.
+                f.truncate(position + written)
+        return written, time.time() - start
+
+    def hash_file(self, f, size, digest):
+        """ Adds the first size bytes of the passed file object to the passed
+            hashlib object. """
+        buf = self._get_buffer()
+        while size > 0:
+            count = f.readinto(buf)
+            if not count:
+                break
+            count = min(count, size)
+            digest.update(buffer(buf, 0, count))
+            size -= count
+
+
+class Metrics(object):
+    """ Thread-safe counters, histograms and gauges which describe the progress
+        and the throughput of a run. Counters and histograms can carry labels,
+        gauges are functions which are called whenever a snapshot is taken. """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def count(self, name, value=1, **labels):
+        """ Adds the passed value to a counter. """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds):
+        """ Adds a duration to a histogram. """
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def gauge(self, name, function):
+        """ Registers a function which returns the current value of a gauge. """
+        with self._lock:
+            self._gauges[name] = function
+
+    def get(self, name, **labels):
+        """ Returns the current value of a counter. """
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def snapshot(self):
+        """ Returns all metrics as a dictionary, together with the rates of the
+            page, file and byte counters since the start of the run. """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict((name, (list(buckets), total, count)) for
+                              name, (buckets, total, count) in self._histograms.items())
+            gauges = dict(self._gauges)
+        elapsed = max(time.time() - self.started, 0.001)
+        data = {"elapsed_seconds": round(elapsed, 3), "counters": {},
+                "histograms": {}, "gauges": {}, "rates": {}}
+        for (name, labels), value in sorted(counters.items()):
+            if labels:
+                data["counters"].setdefault(name, {})[
+                    ",".join("{0}={1}".format(k, v) for k, v in labels)] = value
+            else:
+                data["counters"][name] = value
+        for name, (buckets, total, count) in histograms.items():
+            data["histograms"][name] = {
+                "buckets": dict(zip([str(b) for b in self.BUCKETS], buckets)),
+                "sum": round(total, 6), "count": count}
+        for name, function in gauges.items():
+            data["gauges"][name] = function()
+        for name in ("pages_fetched_total", "files_downloaded_total",
+                     "bytes_downloaded_total"):
+            rate_name = name.replace("_total", "_per_second")
+            data["rates"][rate_name] = round(counters.get((name, ()), 0) / elapsed, 3)
+        return data
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix="pb_shovel_"):
+        """ Returns the metrics in the Prometheus text exposition format. """
+        data = self.snapshot()
+        with self._lock:
+            counters = sorted(self._counters.items())
+        lines = []
+        previous = None
+        for (name, labels), value in counters:
+            if name != previous:
+                lines.append("# TYPE {0}{1} counter".format(prefix, name))
+                previous = name
+            label_text = ",".join('{0}="{1}"'.format(k, v) for k, v in labels)
+            lines.append("{0}{1}{2} {3}".format(prefix, name,
+                         "{" + label_text + "}" if label_text else "", value))
+        for name, histogram in sorted(data["histograms"].items()):
+            lines.append("# TYPE {0}{1} histogram".format(prefix, name))
+            for bound in self.BUCKETS:
+                lines.append('{0}{1}_bucket{{le="{2}"}} {3}'.format(
+                             prefix, name, bound, histogram["buckets"][str(bound)]))
+            lines.append('{0}{1}_bucket{{le="+Inf"}} {2}'.format(prefix, name,
+                                                                 histogram["count"]))
+            lines.append("{0}{1}_sum {2}".format(prefix, name, histogram["sum"]))
+            lines.append("{0}{1}_count {2}".format(prefix, name, histogram["count"]))
+        for group in ("gauges", "rates"):
+            for name, value in sorted(data[group].items()):
+                lines.append("# TYPE {0}{1} gauge".format(prefix, name))
+                lines.append("{0}{1} {2}".format(prefix, name, value))
+        return "\n".join(lines) + "\n"
+
+
+class Profiler(object):
+    """ Measures the wall clock and CPU time spent in the stages of a run and
+        profiles every thread which enters a stage with cProfile. Stages can be
+        nested, the time of a nested stage is not counted for the outer one.
+        Does nothing unless it is enabled. """
+    # Python 2 has no name for it, but RUSAGE_THREAD is 1 on Linux
+    RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD",
+                            1 if sys.platform.startswith("linux") else None)
+
+    def __init__(self, path=None):
+        self.path = path
+        self.enabled = bool(path)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = []
+        # stage -> [calls, wall seconds, CPU seconds]
+        self._stages = {}
+
+    def _get_cpu_time(self):
+        """ Returns the CPU time of the current thread, or of the process when
+            the platform can't tell the time of a single thread. """
+        if resource and self.RUSAGE_THREAD is not None:
+            try:
+                usage = resource.getrusage(self.RUSAGE_THREAD)
+                return usage.ru_utime + usage.ru_stime
+            except(ValueError, resource.error):
+                pass
+        return sum(os.times()[:2])
+
+    def profile_thread(self):
+        """ Starts profiling the current thread with cProfile. """
+        if not self.enabled or getattr(self._local, "profile", None):
+            return
+        self._local.profile = cProfile.Profile()
+        self._local.stack = []
+        with self._lock:
+            self._profiles.append(self._local.profile)
+        self._local.profile.enable()
+
+    @contextmanager
+    def span(self, stage):
+        """ Measures the code of the with block as the passed stage. """
+        if not self.enabled:
+            yield
+            return
+        self.profile_thread()
+        # [wall, cpu] of the nested stages, subtracted from this one
+        nested = [0.0, 0.0]
+        self._local.stack.append(nested)
+        wall, cpu = time.time(), self._get_cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.time() - wall, self._get_cpu_time() - cpu
+            self._local.stack.pop()
+            if self._local.stack:
+                self._local.stack[-1][0] += wall
+                self._local.stack[-1][1] += cpu
+            with self._lock:
+                totals = self._stages.setdefault(stage, [0, 0.0, 0.0])
+                totals[0] += 1
+                totals[1] += wall - nested[0]
+                totals[2] += cpu - nested[1]
+
+    def summary(self):
+        """ Returns a table of the calls, wall and CPU seconds of each stage. """
+        lines = ["{0:<16}{1:>10}{2:>12}{3:>12}".format("Stage", "Calls", "Wall s", "CPU s")]
+        with self._lock:
+            stages = sorted(self._stages.items(), key=lambda item: -item[1][1])
+        for stage, (calls, wall, cpu) in stages:
+            lines.append("{0:<16}{1:>10}{2:>12.3f}{3:>12.3f}".format(stage, calls,
+                                                                    wall, cpu))
+        return "\n".join(lines) + "\n"
+
+    def dump(self):
+        """ Writes the merged cProfile statistics of all threads to the path of
+            the profiler and prints the summary of the stages. """
+        if not self.enabled:
+            return
+        stats = None
+        with self._lock:
+            profiles, self._profiles = self._profiles, []
+        for profile in profiles:
+            profile.disable()
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if stats:
+            stats.dump_stats(self.path)
+        stderr.write("\n" + self.summary())
+        stderr.write("Profile written to {0}\n".format(self.path))
+        stderr.flush()
+
+
+class StatsWriter(threading.Thread):
+    """ Writes the metrics to a file every few seconds, as JSON or in the
+        Prometheus format for the node exporter's textfile collector. The file
+        is replaced atomically, readers never see a half written file. """
+    def __init__(self, metrics, path, fmt="json", interval=10):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._metrics = metrics
+        self._path = path
+        self._format = fmt
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self.write()
+
+    def write(self):
+        text = (self._metrics.to_prometheus() if self._format == "prometheus"
+                else self._metrics.to_json())
+        try:
+            with open(self._path + ".tmp", "w") as f:
+                f.write(text)
+            os.rename(self._path + ".tmp", self._path)
+        except(IOError, OSError) as e:
+            stderr.write("\rFailed to write the stats file ({0})\n".format(e.strerror))
+            stderr.flush()
+
+    def stop(self):
+        """ Stops the thread and writes the final metrics. """
+        self._stopped.set()
+        self.write()
+
+
+class HostLimiter(object):
+    """ Limits the requests to a single host, both the rate at which they are
+        started and the number of requests in flight. The allowed number of
+        requests in flight is halved whenever the host signals that it is
+        overloaded and grows by one after a streak of successful responses. """
+    def __init__(self, rate=0, concurrency=1):
+        self._condition = threading.Condition()
+        self._interval = 1.0 / rate if rate else 0
+        self._next_start = 0
+        self._max_concurrency = max(1, concurrency)
+        self.concurrency = float(self._max_concurrency)
+        self._active = 0
+        self._successes = 0
+        # Set by a Retry-After header, no request is started before that time
+        self.blocked_until = 0
+
+    def acquire(self):
+        """ Waits for a free slot and the next start time of the host. """
+        with self._condition:
+            while self._active >= int(self.concurrency):
+                self._condition.wait(0.5)
+            self._active += 1
+            now = time.time()
+            start = max(now, self._next_start, self.blocked_until)
+            self._next_start = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self, overloaded=False):
+        """ Frees the slot of a finished request and adapts the concurrency. """
+        with self._condition:
+            self._active -= 1
+            if overloaded:
+                self.concurrency = max(1.0, self.concurrency / 2)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if(self._successes >= self.concurrency * 4
+                   and self.concurrency < self._max_concurrency):
+                    self.concurrency += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+
+class RequestScheduler(object):
+    """ Makes the HTTP requests of the crawl and the downloads through a
+        HostLimiter per host. Connection errors and responses which indicate a
+        temporary failure are retried with exponential backoff and jitter, a
+        Retry-After header of the server takes precedence over the backoff. """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    OVERLOAD_STATUSES = (429, 503)
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, rate=0, retries=5, concurrency=1, backoff=1.0, metrics=None):
+        self.metrics = metrics or Metrics()
+        self.rate = rate
+        self.retries = retries
+        self.concurrency = concurrency
+        self.backoff = backoff
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _get_limiter(self, url):
+        """ Returns the limiter of the passed URL's host. """
+        host = urlparse(url).netloc.lower()
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostLimiter(self.rate, self.concurrency)
+            return self._hosts[host]
+
+    def _get_retry_after(self, response):
+        """ Returns the seconds to wait according to the Retry-After header of
+            the passed response, None when it has none. """
+        value = response.headers.get("Retry-After", "").strip()
+        if value.isdigit():
+            return float(value)
+        date = parsedate_tz(value) if value else None
+        if date:
+            return max(0.0, mktime_tz(date) - time.time())
+
+    def _get_backoff(self, attempt):
+        """ Returns a random delay of up to backoff * 2 ^ attempt seconds. """
+        return random.uniform(0, min(self.MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+    def request(self, session, method, url, **kwargs):
+        """ Makes a request with the passed session (or the requests module) and
+            returns the response, the last one when all retries failed. Raises
+            the RequestException of the last attempt when there was no response
+            at all. """
+        limiter = self._get_limiter(url)
+        attempt = 0
+        while 1:
+            limiter.acquire()
+            start = time.time()
+            try:
+                response = session.request(method, url, **kwargs)
+            except(requests.exceptions.ConnectionError,
+                   requests.exceptions.Timeout):
+                limiter.release(overloaded=True)
+                self.metrics.count("request_errors_total")
+                if attempt >= self.retries:
+                    stderr.write("\rGiving up on {0} after {1} retries\n".format(
+                                 url, attempt))
+                    stderr.flush()
+                    raise
+                delay = self._get_backoff(attempt)
+            else:
+                status = response.status_code
+                limiter.release(overloaded=status in self.OVERLOAD_STATUSES)
+                self.metrics.observe("request_seconds", time.time() - start)
+                self.metrics.count("http_responses_total", status=status)
+                if status not in self.RETRY_STATUSES:
+                    return response
+                if attempt >= self.retries:
+                    stderr.write("\rGiving up on {0} after {1} retries (status {2})\n"
+                                 .format(url, attempt, status))
+                    stderr.flush()
+                    return response
+                retry_after = self._get_retry_after(response)
+                response.close()
+                delay = self._get_backoff(attempt)
+                if retry_after is not None:
+                    # Hold back every request to the host, not just this one.
+                    delay = min(retry_after, self.MAX_BACKOFF * 5)
+                    limiter.blocked_until = max(limiter.blocked_until,
+                                                time.time() + delay)
+            self.metrics.count("retries_total")
+            time.sleep(delay)
+            attempt += 1
+
+
+class ResponseCache(object):
+    """ An on-disk cache of GET responses, keyed by URL. Responses which carry
+        an ETag or Last-Modified header are stored together with the body, the
+        next request for the same URL is made conditional and a '304 Not
+        Modified' is answered with the stored body. The least recently used
+        entries are removed when the cache grows beyond its maximum size. """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._size = sum(os.path.getsize(os.path.join(path, f))
+                         for f in os.listdir(path))
+        if self._size > self.max_size:
+            self._evict()
+
+    def _get_paths(self, key):
+        """ Returns the paths of the metadata and the body of a cache entry. """
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return (os.path.join(self.path, name + ".json"),
+                os.path.join(self.path, name + ".body"))
+
+    def _load(self, key):
+        """ Returns the metadata and body stored under the passed key. """
+        meta_path, body_path = self._get_paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except(IOError, ValueError):
+            return None, None
+        # Mark the entry as recently used for the eviction.
+        try:
+            os.utime(meta_path, None)
+        except OSError:
+            pass
+        return meta, body
+
+    def _store(self, key, response):
+        """ Stores the passed response when it can be validated later on. """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        meta = {"url": response.url, "etag": etag, "last_modified": last_modified,
+                "headers": dict(response.headers)}
+        meta_path, body_path = self._get_paths(key)
+        with self._lock:
+            for path, data in ((body_path, response.content),
+                               (meta_path, json.dumps(meta))):
+                if os.path.isfile(path):
+                    self._size -= os.path.getsize(path)
+                # Write to a temporary file first, a reader never sees half
+                # a file.
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.rename(path + ".tmp", path)
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """ Removes the least recently used entries until the cache is below 90%
+            of its maximum size. """
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".json"):
+                path = os.path.join(self.path, name)
+                entries.append((os.path.getmtime(path), path))
+        for _, meta_path in sorted(entries):
+            if self._size <= self.max_size * 0.9:
+                break
+            for path in (meta_path, meta_path[:-len(".json")] + ".body"):
+                try:
+                    self._size -= os.path.getsize(path)
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def get(self, fetch, url, key=None, **kwargs):
+        """ Makes a GET request with the passed fetch function, conditional when
+            the cache has an entry for the URL (or the passed cache key). """
+        key = key or url
+        meta, body = self._load(key)
+        headers = kwargs.pop("headers", {})
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        response = fetch(url, headers=headers, **kwargs)
+        if response.status_code == requests.codes.not_modified and meta:
+            # Rebuild the response from the cache, the body is still valid.
+            response.status_code = requests.codes.ok
+            response._content = body
+            response.headers.update(meta.get("headers", {}))
+        elif response.status_code == requests.codes.ok:
+            self._store(key, response)
+        return response
+
+
+class Page(str):
+    """ The source of a fetched page. It is used like the plain source string,
+        but the page is parsed at most once and the values which are extracted
+        from it are cached. Most of them are found with a regular expression
+        first, the BeautifulSoup DOM is only built when that fails. """
+    _TOKEN_INPUT = re.compile("<input\\b[^>]*\\bid=[\"']token[\"'][^>]*>")
+    _VALUE_ATTR = re.compile("\\bvalue=[\"']([^\"']*)[\"']")
+    _COLLECTION_DATA = re.compile("collectionData:.*?\n")
+
+    @classmethod
+    def of(cls, source):
+        """ Returns the passed source as page, without parsing it again when it
+            already is one. """
+        if isinstance(source, cls):
+            return source
+        return cls(source or "")
+
+    @property
+    def soup(self):
+        """ The parsed DOM of the page, built on first access. """
+        if "_soup" not in self.__dict__:
+            self._soup = BeautifulSoup(self, HTML_PARSER)
+        return self._soup
+
+    @property
+    def token(self):
+        """ The value of the 'token' input, None when the page has none. """
+        if "_token" not in self.__dict__:
+            token = None
+            match = self._TOKEN_INPUT.search(self)
+            if match:
+                value = self._VALUE_ATTR.search(match.group())
+                token = value.group(1) if value else None
+            if token is None and 'token' in self:
+                try:
+                    token = self.soup.find(id="token")["value"]
+                except(TypeError, KeyError):
+                    pass
+            self._token = token
+        return self._token
+
+    @property
+    def guest_form(self):
+        """ The guest password form of the page, None when there is none. """
+        if "_guest_form" not in self.__dict__:
+            self._guest_form = None
+            if "guestLoginForm" in self:
+                self._guest_form = self.soup.find("form", id="guestLoginForm")
+        return self._guest_form
+
+    @property
+    def album_json(self):
+        """ The parsed 'var albumJson' data of the page. """
+        if "_album_json" not in self.__dict__:
+            data = re.search("var albumJson.*\n", self)
+            data = data.group().replace("var albumJson = ", "").strip()[:-1]
+            self._album_json = json.loads(data)
+        return self._album_json
+
+    def collection_data(self, collection_id):
+        """ Returns the parsed 'collectionData' of the script which belongs to
+            the passed collection id, None when it can't be found. """
+        cache = self.__dict__.setdefault("_collection_data", {})
+        if collection_id not in cache:
+            data = self._find_collection_data(collection_id)
+            cache[collection_id] = json.loads(data) if data else None
+        return cache[collection_id]
+
+    def _find_collection_data(self, collection_id):
+        """ Returns the raw 'collectionData' of the passed collection id. """
+        marker = "collectionId: '{0}'".format(collection_id)
+        position = self.find(marker)
+        if position == -1:
+            return
+        # Only search within the script which contains the collection id.
+        start = self.rfind("<script", 0, position)
+        end = self.find("</script>", position)
+        match = self._COLLECTION_DATA.search(self, max(start, 0),
+                                             end if end != -1 else len(self))
+        if match:
+            data = match.group()
+        else: # Fall back to the DOM when the data isn't laid out as expected
+            data = None
+            for blob in self.soup.find_all("script"):
+                if marker in blob.text:
+                    data = re.search("collectionData:.*?\n", blob.text)
+                    data = data.group() if data else None
+            if not data:
+                return
+        data = data.strip().replace("collectionData: ", "").strip()
+        if(data.endswith("},")):
+            data = data[:-1]
+        return data
+
+
+class StateStore(object):
+    """ Checkpoints the progress of a run in a SQLite database, so that an
+        interrupted run can be resumed with --resume. The database records the
+        albums which have been visited, the last page which was extracted from
+        each of them, the media which has been found and whether it has been
+        downloaded already. Every change is committed right away. """
+    _SCHEMA = ("CREATE TABLE IF NOT EXISTS albums ("
+               "url TEXT PRIMARY KEY, parent TEXT, last_page INTEGER DEFAULT 0,"
+               " done INTEGER DEFAULT 0, expanded INTEGER DEFAULT 0)",
+               "CREATE TABLE IF NOT EXISTS media ("
+               "link TEXT PRIMARY KEY, album TEXT, filename TEXT, title TEXT,"
+               " mediaType TEXT, likeCount INTEGER, commentCount INTEGER,"
+               " viewCount INTEGER, username TEXT, status TEXT DEFAULT 'pending')")
+    _MEDIA_COLUMNS = ("link", "album", "filename", "title", "mediaType", "likeCount",
+                      "commentCount", "viewCount", "username")
+
+    def __init__(self, path, resume=False):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for statement in self._SCHEMA:
+            self._db.execute(statement)
+        if not resume:
+            # A new run, forget everything about the previous one.
+            self._db.execute("DELETE FROM albums")
+            self._db.execute("DELETE FROM media")
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+    def _execute(self, statement, *params):
+        with self._lock:
+            rows = self._db.execute(statement, params).fetchall()
+            self._db.commit()
+        return rows
+
+    def album_progress(self, url):
+        """ Returns the last page which was extracted from the passed album, None
+            when the album has been extracted completely. """
+        rows = self._execute("SELECT last_page, done FROM albums WHERE url = ?", url)
+        if not rows:
+            return 0
+        last_page, done = rows[0]
+        return None if done else last_page
+
+    def add_page(self, url, page, image_links):
+        """ Records the media of an extracted album page. Returns the media which
+            hasn't been downloaded yet and the number of media which hadn't been
+            recorded before. """
+        with self._lock:
+            if url:
+                self._db.execute("INSERT OR IGNORE INTO albums (url) VALUES (?)", (url,))
+                self._db.execute("UPDATE albums SET last_page = ? WHERE url = ?",
+                                 (page, url))
+            fresh = []
+            new = 0
+            for info in image_links:
+                row = self._db.execute("SELECT status FROM media WHERE link = ?",
+                                       (info.link,)).fetchone()
+                if row is None:
+                    new += 1
+                    values = [info.link, url] + [getattr(info, column) for column
+                                                 in self._MEDIA_COLUMNS[2:]]
+                    self._db.execute("INSERT INTO media ({0}) VALUES ({1})".format(
+                                        ", ".join(self._MEDIA_COLUMNS),
+                                        ", ".join("?" * len(values))), values)
+                if row is None or row[0] != "done":
+                    fresh.append(info)
+            self._db.commit()
+        return fresh, new
+
+    def start_sync(self):
+        """ Forgets the progress of the albums but keeps the recorded media, so
+            that a --sync run walks every album again from its first page. """
+        self._execute("UPDATE albums SET last_page = 0, done = 0, expanded = 0")
+
+    def finish_album(self, url):
+        """ Marks the passed album as completely extracted. """
+        self._execute("INSERT OR IGNORE INTO albums (url) VALUES (?)", url)
+        self._execute("UPDATE albums SET done = 1 WHERE url = ?", url)
+
+    def sub_albums(self, url):
+        """ Returns the sub-albums of the passed album when they have been
+            recorded already, None otherwise. """
+        rows = self._execute("SELECT expanded FROM albums WHERE url = ?", url)
+        if not rows or not rows[0][0]:
+            return
+        return [row[0] for row in
+                self._execute("SELECT url FROM albums WHERE parent = ?", url)]
+
+    def add_sub_albums(self, url, sub_albums):
+        """ Records the sub-albums of the passed album. """
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO albums (url) VALUES (?)", (url,))
+            for sub_album in sub_albums:
+                self._db.execute("INSERT OR IGNORE INTO albums (url, parent) "
+                                 "VALUES (?, ?)", (sub_album, url))
+            self._db.execute("UPDATE albums SET expanded = 1 WHERE url = ?", (url,))
+            self._db.commit()
+
+    def set_status(self, link, status):
+        """ Sets the download status ('pending', 'done' or 'failed') of a file. """
+        self.set_statuses([link], status)
+
+    def set_statuses(self, links, status):
+        """ Sets the download status of the passed files in one transaction. """
+        with self._lock:
+            self._db.executemany("UPDATE media SET status = ? WHERE link = ?",
+                                 ((status, link) for link in links))
+            self._db.commit()
+
+    def merge(self, path):
+        """ Adds the albums and media recorded in the state file at the passed
+            path, e.g. by another shard of the same input. When both files know
+            an album or file the further progress is kept. """
+        with self._lock:
+            self._db.execute("ATTACH DATABASE ? AS other", (path,))
+            try:
+                self._db.execute("INSERT OR IGNORE INTO albums (url, parent, last_page,"
+                                 " done, expanded) SELECT url, parent, last_page, done,"
+                                 " expanded FROM other.albums")
+                for column in ("last_page", "done", "expanded"):
+                    self._db.execute("UPDATE albums SET {0} = max({0}, (SELECT o.{0}"
+                                     " FROM other.albums o WHERE o.url = albums.url))"
+                                     " WHERE url IN (SELECT url FROM other.albums)"
+                                     .format(column))
+                columns = ", ".join(self._MEDIA_COLUMNS + ("status",))
+                self._db.execute("INSERT OR IGNORE INTO media ({0}) SELECT {0} FROM"
+                                 " other.media".format(columns))
+                self._db.execute("UPDATE media SET status = 'done' WHERE status !="
+                                 " 'done' AND link IN (SELECT link FROM other.media"
+                                 " WHERE status = 'done')")
+                self._db.commit()
+            finally:
+                self._db.execute("DETACH DATABASE other")
+
+    def pending(self):
+        """ Returns the media which has been found but not downloaded yet. """
+        rows = self._execute("SELECT {0} FROM media WHERE status != 'done' ORDER BY "
+                             "rowid".format(", ".join(self._MEDIA_COLUMNS)))
+        image_links = []
+        for row in rows:
+            values = dict(zip(self._MEDIA_COLUMNS, row))
+            values["originalUrl"] = values.pop("link")
+            image_links.append(ImageInfo(values.pop("filename"), **values))
+        return image_links
+
+
+class OutputIndex(object):
+    """ An in-memory index of the file names in the output directory. The
+        directory is listed once, afterwards the index is updated with every
+        name which is handed out, so checking whether a file exists and finding
+        the next free 'photo(1).jpg', 'photo(2).jpg' name doesn't touch the disk. """
+    def __init__(self, path):
+        self.path = path
+        self._names = set(os.listdir(path)) if path else set()
+        # The next suffix to try for a name which is taken already
+        self._suffixes = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def add(self, name):
+        """ Marks the passed name as taken. """
+        with self._lock:
+            self._names.add(name)
+
+    def unique_name(self, name):
+        """ Returns the passed name, or 'name(N).ext' with the lowest free N when
+            it is taken already, and marks the returned name as taken. """
+        with self._lock:
+            if name not in self._names:
+                self._names.add(name)
+                return name
+            if "." in name:
+                base, extension = name[:name.rindex(".")], name[name.rindex("."):]
+            else:
+                base, extension = name, ""
+            unique = self._suffixes.get(name, 1)
+            new_name = "{0}({1}){2}".format(base, unique, extension)
+            while new_name in self._names:
+                unique += 1
+                new_name = "{0}({1}){2}".format(base, unique, extension)
+            self._suffixes[name] = unique + 1
+            self._names.add(new_name)
+            return new_name
+
+
+class ContentStore(object):
+    """ Keeps the SHA-256 digests of the files in the output directory in a
+        SHA256SUMS file, which 'sha256sum -c' can verify. A downloaded file
+        with the content of a file in the store is hardlinked to that file or,
+        in 'skip' mode, not kept at all. The paths in the file are relative to
+        the directory of the file. """
+    MODES = ("hardlink", "skip")
+
+    def __init__(self, path, mode="hardlink"):
+        self.path = path
+        self.mode = mode
+        self._root = os.path.dirname(os.path.abspath(path))
+        # The path of the first file with each digest
+        self._files = {}
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    digest, _, name = line.rstrip("\n").partition(" ")
+                    # 'sha256sum' writes ' *' in front of binary names
+                    self._files.setdefault(digest, name[1:])
+        self._file = open(path, "ab")
+        self._lock = threading.Lock()
+
+    def add(self, digest, part, out):
+        """ Moves the complete download part with the passed hex digest to out,
+            or links out to the file which has the same content and removes
+            part. Returns the path of the file with the content, which is None
+            when the download has been dropped. """
+        with self._lock:
+            name = self._files.get(digest)
+            existing = name and os.path.join(self._root, name)
+            if existing and os.path.isfile(existing):
+                if self.mode == "skip":
+                    os.remove(part)
+                    return
+                try:
+                    os.link(existing, out)
+                except OSError:
+                    # E.g. a file system without hardlinks, keep the copy
+                    os.rename(part, out)
+                else:
+                    os.remove(part)
+            else:
+                os.rename(part, out)
+                self._files[digest] = os.path.relpath(out, self._root)
+            self._record(digest, out)
+            return existing or out
+
+    def _record(self, digest, path):
+        """ Appends the passed digest and path to the SHA256SUMS file. """
+        name = os.path.relpath(path, self._root)
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        self._file.write("{0}  {1}\n".format(digest, name))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class WorkQueue(object):
+    """ Hands out the lines of a file to several processes on the same machine,
+        each line goes to the one process which claims it first. The offset of
+        the next unclaimed line is kept in '<file>.offset', which is locked
+        while a line is claimed. Removing the offset file starts over. """
+    def __init__(self, path):
+        if fcntl is None:
+            raise IOError("file locking isn't supported on this platform")
+        self._file = open(path)
+        self._offset_fd = os.open(path + ".offset", os.O_RDWR | os.O_CREAT, 0o644)
+
+    def __iter__(self):
+        while 1:
+            line = self._claim()
+            if not line:
+                return
+            yield line
+
+    def _claim(self):
+        """ Returns the next unclaimed line, an empty string at the end. """
+        fcntl.flock(self._offset_fd, fcntl.LOCK_EX)
+        try:
+            os.lseek(self._offset_fd, 0, os.SEEK_SET)
+            offset = os.read(self._offset_fd, 32).strip()
+            self._file.seek(int(offset or 0))
+            line = self._file.readline()
+            if line:
+                os.lseek(self._offset_fd, 0, os.SEEK_SET)
+                os.ftruncate(self._offset_fd, 0)
+                os.write(self._offset_fd, str(self._file.tell()))
+            return line
+        finally:
+            fcntl.flock(self._offset_fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self._file.close()
+        os.close(self._offset_fd)
+
+
+class SessionStore(object):
+    """ Keeps the cookies of the session in a file between runs, the login and
+        the guest passwords then only have to be sent again once the cookies
+        have expired. Cookies without an expiry date are kept for MAX_AGE
+        seconds after the login. The file is only readable by its owner. """
+    MAX_AGE = 24 * 60 * 60
+
+    def __init__(self, path):
+        self.path = path
+        # When the cookies of the file were obtained
+        self.since = None
+
+    def load(self, session, username=None):
+        """ Adds the cookies from the file which haven't expired to the passed
+            session. Returns False when there is no file or when it belongs to
+            another account. """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except(IOError, ValueError):
+            return False
+        if data.get("username") != username:
+            return False
+        now = time.time()
+        self.since = data.get("since") or now
+        for cookie in data.get("cookies", []):
+            expires = cookie.get("expires")
+            if expires is None and now - self.since > self.MAX_AGE:
+                continue
+            if expires is not None and expires <= now:
+                continue
+            session.cookies.set_cookie(requests.cookies.create_cookie(**cookie))
+        return True
+
+    def save(self, session, username=None):
+        """ Writes the cookies of the passed session to the file. """
+        cookies = [{"name": cookie.name, "value": cookie.value,
+                    "domain": cookie.domain, "path": cookie.path,
+                    "expires": cookie.expires, "secure": cookie.secure,
+                    "rest": cookie._rest} for cookie in session.cookies]
+        data = {"username": username, "since": self.since or time.time(),
+                "cookies": cookies}
+        temp = self.path + ".tmp"
+        if os.path.exists(temp):
+            os.remove(temp)
+        with os.fdopen(os.open(temp, os.O_WRONLY | os.O_CREAT, 0o600), "w") as f:
+            json.dump(data, f)
+        os.rename(temp, self.path)
+
+
+class LinkExporter(object):
+    """ Writes the links of the collected files to a file instead of downloading
+        them, either as plain list of URLs, as aria2c input file which names
+        each file like a download would, or as JSON lines with the information
+        about each file. The file is opened once and written through a large
+        buffer. """
+    FORMATS = ("urls", "aria2", "jsonl")
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, path, fmt="urls", echo=True):
+        self.path = path
+        self.fmt = fmt
+        # Prints every URL to stdout as well
+        self.echo = echo
+        self._file = None
+        self._names = OutputIndex(None)
+        self._lock = threading.Lock()
+
+    def _format(self, file_info):
+        """ Returns the lines which are written for the passed image object. """
+        if self.fmt == "aria2":
+            name = self._names.unique_name(file_info.filename)
+            return "{0}\n  out={1}\n".format(_encode(file_info.link), _encode(name))
+        if self.fmt == "jsonl":
+            return json.dumps({"url": file_info.link,
+                               "filename": file_info.filename,
+                               "title": file_info.title,
+                               "mediaType": file_info.mediaType,
+                               "likeCount": file_info.likeCount,
+                               "commentCount": file_info.commentCount,
+                               "viewCount": file_info.viewCount,
+                               "username": file_info.username}) + "\n"
+        return _encode(file_info.link) + "\n"
+
+    def write(self, file_infos):
+        """ Writes the links of the passed image objects. """
+        with self._lock:
+            if self._file is None:
+                if self.path == "-":
+                    self._file = sys.stdout
+                else:
+                    self._file = open(self.path, "a", self.BUFFER_SIZE)
+            lines = [self._format(file_info) for file_info in file_infos]
+            self._file.write("".join(lines))
+            if self.echo and self._file is not sys.stdout:
+                sys.stdout.write("".join(_encode(file_info.link) + "\n"
+                                         for file_info in file_infos))
+
+    def close(self):
+        """ Flushes the written links to the file. """
+        with self._lock:
+            if self._file is sys.stdout:
+                self._file.flush()
+            elif self._file is not None:
+                self._file.close()
+            self._file = None
+
+
+def _encode(value):
+    """ Returns the passed string as UTF-8 encoded byte string. """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+class ArchiveSink(object):
+    """ Writes the downloaded files as members of an archive instead of as
+        separate files. Each volume of the archive holds up to volume_size bytes
+        (one member can go beyond), then the next volume 'name.1.tar',
+        'name.2.tar', ... is started. Existing volumes are never overwritten, a
+        new run starts with the next free volume. Every member is recorded in
+        'name.index.jsonl' together with its volume and offset. The container
+        format is implemented by the subclasses, see for_path. Formats which
+        don't need to go back to the header of a member can write it while it
+        is received, see open_member. """
+    # A download is kept in memory up to this size before it spills to disk
+    SPOOL_SIZE = 8 * 1024 * 1024
+    EXTENSION = None
+    STREAMS = False
+
+    @staticmethod
+    def for_path(path, volume_size=0):
+        """ Returns the sink for the format of the passed archive name. """
+        for sink in (WarcSink, TarSink, ZipSink):
+            if path.lower().endswith(sink.EXTENSION) or sink is WarcSink\
+               and path.lower().endswith(sink.EXTENSION + ".gz"):
+                return sink(path, volume_size)
+        raise ValueError("unknown archive format of {0}, use .tar, .zip,"
+                         " .warc or .warc.gz".format(path))
+
+    def __init__(self, path, volume_size=0):
+        self.path = path
+        self.volume_size = volume_size
+        start = path.lower().rindex(self.EXTENSION)
+        self._base, self._extension = path[:start], path[start:]
+        self._volume = None
+        self._number = -1
+        self._names = OutputIndex(None)
+        self._index = None
+        self._member = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def spool(self):
+        """ Returns the file object a download is received into before it is
+            added. """
+        return tempfile.SpooledTemporaryFile(self.SPOOL_SIZE)
+
+    def _volume_path(self, number):
+        if not number:
+            return self.path
+        return "{0}.{1}{2}".format(self._base, number, self._extension)
+
+    def _next_volume(self):
+        """ Closes the current volume and opens the next free one. """
+        if self._volume is not None:
+            self._close()
+        self._number += 1
+        while os.path.exists(self._volume_path(self._number)):
+            self._number += 1
+        self._volume = self._volume_path(self._number)
+        self._open(self._volume)
+
+    def _start(self, file_info):
+        """ Starts the next volume when the current one is full and returns the
+            name and offset of the next member for the passed image object. """
+        if self._volume is None or self.volume_size and self._tell() >= self.volume_size:
+            self._next_volume()
+        if self._index is None:
+            self._index = open(self._base + ".index.jsonl", "a")
+        return self._names.unique_name(file_info.filename), self._tell()
+
+    def _record(self, name, offset, size, file_info):
+        """ Adds a member to the index. """
+        self._index.write(json.dumps({"volume": os.path.basename(self._volume),
+                                      "offset": offset,
+                                      "name": name,
+                                      "size": size,
+                                      "url": file_info.link,
+                                      "mediaType": file_info.mediaType,
+                                      "username": file_info.username}) + "\n")
+
+    def add(self, file_info, f, size, response, done=None):
+        """ Adds the data of the passed file object of the passed size as member
+            for the passed image object, response is the response the data was
+            received with. While a member is written by open_member the data is
+            added after it, done is called once the data has been added. """
+        with self._lock:
+            if self._member is not None:
+                self._pending.append((file_info, f, size, response, done))
+                return
+            self._write(file_info, f, size, response)
+        if done is not None:
+            done()
+
+    def _write(self, file_info, f, size, response):
+        name, offset = self._start(file_info)
+        f.seek(0)
+        self._add(name, f, size, file_info, response)
+        self._record(name, offset, size, file_info)
+
+    def open_member(self, file_info, size, response):
+        """ Starts a member of the passed size for the passed image object and
+            returns the file object its data is written to as it is received.
+            Returns None when the format can't do that or another member is
+            being written, the data has to be passed to add then. close_member
+            has to be called once the data has been written. """
+        if not self.STREAMS:
+            return None
+        with self._lock:
+            if self._member is not None:
+                return None
+            name, offset = self._start(file_info)
+            f = self._begin(name, size, file_info, response)
+            self._member = (name, offset, size, file_info)
+            return f
+
+    def close_member(self, complete):
+        """ Finishes the member started by open_member, or removes it from the
+            volume when its data is incomplete. Then adds the data which has been
+            passed to add in the meantime. """
+        with self._lock:
+            name, offset, size, file_info = self._member
+            if complete:
+                self._end(size)
+                self._record(name, offset, size, file_info)
+            else:
+                self._discard(offset)
+            self._member = None
+            pending, self._pending = self._pending, []
+            for file_info, f, size, response, done in pending:
+                self._write(file_info, f, size, response)
+        for file_info, f, size, response, done in pending:
+            if done is not None:
+                done()
+
+    def close(self):
+        """ Finishes the current volume and the index. """
+        with self._lock:
+            if self._volume is not None:
+                self._close()
+                self._volume = None
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+
+
+class TarSink(ArchiveSink):
+    """ Writes the members to uncompressed tar volumes. """
+    EXTENSION = ".tar"
+    STREAMS = True
+
+    def _open(self, path):
+        self._tar = tarfile.open(path, "w", format=tarfile.PAX_FORMAT,
+                                 encoding="utf-8")
+
+    def _tell(self):
+        return self._tar.offset
+
+    def _info(self, name, size):
+        info = tarfile.TarInfo(_encode(name))
+        info.size = size
+        info.mtime = time.time()
+        info.mode = 0o644
+        return info
+
+    def _add(self, name, f, size, file_info, response):
+        self._tar.addfile(self._info(name, size), f)
+
+    def _begin(self, name, size, file_info, response):
+        # Does what TarFile.addfile does, with the data written by the caller
+        self._streamed = self._info(name, size)
+        header = self._streamed.tobuf(self._tar.format, self._tar.encoding,
+                                      self._tar.errors)
+        self._tar.fileobj.write(header)
+        self._tar.offset += len(header)
+        return self._tar.fileobj
+
+    def _end(self, size):
+        blocks, remainder = divmod(size, tarfile.BLOCKSIZE)
+        if remainder:
+            self._tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self._tar.offset += blocks * tarfile.BLOCKSIZE
+        self._tar.members.append(self._streamed)
+
+    def _discard(self, offset):
+        self._tar.fileobj.seek(offset)
+        self._tar.fileobj.truncate()
+        self._tar.offset = offset
+
+    def _close(self):
+        self._tar.close()
+
+
+class NamedSpool(tempfile.SpooledTemporaryFile):
+    """ A SpooledTemporaryFile which spills into a named file, so the data can
+        be passed on by its path once it got too large for memory. """
+    def rollover(self):
+        if self._rolled:
+            return
+        data = self._file
+        self._file = tempfile.NamedTemporaryFile(*self._TemporaryFileArgs)
+        del self._TemporaryFileArgs
+        self._file.write(data.getvalue())
+        self._file.seek(data.tell(), 0)
+        self._rolled = True
+
+    @property
+    def path(self):
+        """ The path of the file, None while the data is in memory. """
+        return self._file.name if self._rolled else None
+
+
+class ZipSink(ArchiveSink):
+    """ Writes the members to zip volumes without compression, the media is
+        compressed already. The zipfile module of Python 2 can't write a member
+        from a file object, small files are added from memory and the others
+        from the file they spilled into, which is copied in chunks. """
+    EXTENSION = ".zip"
+
+    def spool(self):
+        return NamedSpool(self.SPOOL_SIZE, dir=os.path.dirname(os.path.abspath(self.path)),
+                          prefix=".pb_spool_")
+
+    def _open(self, path):
+        self._zip = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED, allowZip64=True)
+
+    def _tell(self):
+        return self._zip.fp.tell()
+
+    def _add(self, name, f, size, file_info, response):
+        if getattr(f, "path", None):
+            f.flush()
+            os.chmod(f.path, 0o644)
+            self._zip.write(f.path, _encode(name))
+            return
+        info = zipfile.ZipInfo(_encode(name), time.localtime()[:6])
+        info.external_attr = 0o644 << 16
+        self._zip.writestr(info, f.read())
+
+    def _close(self):
+        self._zip.close()
+
+
+class WarcSink(ArchiveSink):
+    """ Writes the responses of the downloads as WARC response records, each
+        record is compressed on its own for '.warc.gz' volumes. The headers of
+        the response are recorded as they were received, except for the ones
+        which describe an encoding of the body that has been undone. """
+    EXTENSION = ".warc"
+    STREAMS = True
+    _SKIPPED_HEADERS = ("content-encoding", "transfer-encoding", "content-length")
+
+    def _open(self, path):
+        self._file = open(path, "wb")
+        self._compress = path.lower().endswith(".gz")
+        info = "software: pb_shovel\r\nformat: WARC File Format 1.0\r\n"
+        self._write_record({"WARC-Type": "warcinfo",
+                            "WARC-Filename": os.path.basename(path),
+                            "Content-Type": "application/warc-fields"}, info)
+
+    def _tell(self):
+        return self._file.tell()
+
+    def _write_record(self, headers, block, f=None, size=0):
+        """ Writes a record with the passed headers and block, followed by the
+            passed size of data from the file object f. """
+        out = self._begin_record(headers, block, size)
+        if f is not None:
+            shutil.copyfileobj(f, out, 1024 * 1024)
+        self._end_record(out)
+
+    def _begin_record(self, headers, block, size):
+        """ Writes the head of a record with the passed headers and block, and
+            returns the file object the following size bytes are written to. """
+        headers = [("WARC-Type", headers.pop("WARC-Type")),
+                   ("WARC-Record-ID", "<urn:uuid:{0}>".format(uuid.uuid4())),
+                   ("WARC-Date", datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"))]\
+                  + sorted(headers.items())\
+                  + [("Content-Length", str(len(block) + size))]
+        out = self._file
+        if self._compress:
+            out = gzip.GzipFile(fileobj=self._file, mode="wb")
+        out.write("WARC/1.0\r\n")
+        out.write("".join("{0}: {1}\r\n".format(k, _encode(v)) for k, v in headers))
+        out.write("\r\n")
+        out.write(block)
+        return out
+
+    def _end_record(self, out):
+        out.write("\r\n\r\n")
+        if self._compress:
+            out.close()
+
+    def _response_record(self, size, file_info, response):
+        """ Returns the headers and the block of the response record. """
+        http = ["HTTP/1.1 {0} {1}".format(response.status_code, response.reason or "")]
+        http.extend("{0}: {1}".format(k, v) for k, v in response.headers.items()
+                    if k.lower() not in self._SKIPPED_HEADERS)
+        http.append("Content-Length: {0}".format(size))
+        return ({"WARC-Type": "response",
+                 "WARC-Target-URI": file_info.link,
+                 "Content-Type": "application/http; msgtype=response"},
+                "\r\n".join(http) + "\r\n\r\n")
+
+    def _add(self, name, f, size, file_info, response):
+        headers, block = self._response_record(size, file_info, response)
+        self._write_record(headers, block, f, size)
+
+    def _begin(self, name, size, file_info, response):
+        headers, block = self._response_record(size, file_info, response)
+        self._streamed = self._begin_record(headers, block, size)
+        return self._streamed
+
+    def _end(self, size):
+        self._end_record(self._streamed)
+
+    def _discard(self, offset):
+        if self._compress:
+            # Keep the unfinished member from writing its trailer when collected
+            self._streamed.fileobj = None
+        self._file.seek(offset)
+        self._file.truncate()
+
+    def _close(self):
+        self._file.close()
+
+
+class BloomFilter(object):
+    """ A set of hashes which is stored in a file and takes a few bytes per
+        member no matter how long the members are. Testing whether something is
+        a member can give a false positive with the passed error rate once the
+        filter holds its capacity, but never a false negative. """
+    _HEADER = struct.Struct("<4sQB")
+    _MAGIC = "PBBF"
+
+    def __init__(self, path, capacity=1000000, error_rate=1e-6):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                header = f.read(self._HEADER.size)
+                if len(header) != self._HEADER.size:
+                    raise ValueError("{0} is not a seen file".format(path))
+                magic, self._size, self._hashes = self._HEADER.unpack(header)
+                self._bits = bytearray(f.read())
+            if magic != self._MAGIC or len(self._bits) != (self._size + 7) // 8:
+                raise ValueError("{0} is not a seen file".format(path))
+        else:
+            capacity = max(1, capacity)
+            self._size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+            self._hashes = max(1, int(round(self._size / float(capacity) * math.log(2))))
+            self._bits = bytearray((self._size + 7) // 8)
+
+    def _positions(self, digest):
+        """ Returns the bits which are set for the passed digest of at least 16
+            bytes. """
+        first, second = struct.unpack("<QQ", digest[:16])
+        return [(first + i * second) % self._size for i in xrange(self._hashes)]
+
+    def __contains__(self, digest):
+        bits = self._bits
+        return all(bits[position >> 3] & 1 << (position & 7)
+                   for position in self._positions(digest))
+
+    def add(self, digest):
+        """ Adds the passed digest to the filter. """
+        positions = self._positions(digest)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+
+    def save(self):
+        """ Writes the filter to its file, replacing the file atomically. """
+        with self._lock:
+            with open(self.path + ".tmp", "wb") as f:
+                f.write(self._HEADER.pack(self._MAGIC, self._size, self._hashes))
+                f.write(self._bits)
+            os.rename(self.path + ".tmp", self.path)
+
+
+class MediaIndex(object):
+    """ Remembers the files which have been collected during the run by their
+        normalized link, so a file is only collected once even when it is found
+        through several inputs. Only a short hash of each link is kept. With a
+        BloomFilter the files which were downloaded by earlier runs are left out
+        as well. """
+    def __init__(self, seen=None):
+        self._seen = seen
+        self._digests = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._digests)
+
+    def add(self, image_info):
+        """ Adds the passed image object, returns False when it has been
+            collected or downloaded before. """
+        digest = hashlib.sha1(image_info.key).digest()
+        if self._seen is not None and digest in self._seen:
+            return False
+        with self._lock:
+            if digest[:8] in self._digests:
+                return False
+            self._digests.add(digest[:8])
+            return True
+
+    def done(self, image_info):
+        """ Remembers the passed image object as downloaded for later runs. """
+        if self._seen is not None:
+            self._seen.add(hashlib.sha1(image_info.key).digest())
+
+    def close(self):
+        """ Writes the downloaded files to the seen file. """
+        if self._seen is not None:
+            self._seen.save()
 
 
 class Photobucket():
@@ -50,24 +1766,136 @@ class Photobucket():
     def __init__(self, args):
         self._args = args
         self._session = requests.session()
-        self._configure_session()
+        self.profiler = Profiler(args.profile)
+        self.profiler.profile_thread()
+        self.metrics = Metrics()
+        self._stats_writer = None
+        if args.stats_file:
+            fmt = args.stats_format
+            if not fmt:
+                fmt = "prometheus" if args.stats_file.endswith(".prom") else "json"
+            self._stats_writer = StatsWriter(self.metrics, args.stats_file, fmt,
+                                             args.stats_interval)
+            self._stats_writer.start()
+        self._scheduler = RequestScheduler(args.rate, args.retries, args.jobs,
+                                           metrics=self.metrics)
+        # Keeps the cookies between runs when --session-file was passed
+        self._sessions = None
+        if args.session_file:
+            self._sessions = SessionStore(args.session_file)
+        # Caches the pages of the crawl when the --cache-dir argument was passed,
+        # set up before the login, which already fetches a page
+        self._cache = None
+        if self._args.cache_dir:
+            self._cache = ResponseCache(self._args.cache_dir,
+                                        self._args.cache_size * 1024 * 1024)
         self._authenticated = False
+        self._configure_session()
         self.collected_links = []
         self._downloaded_images = 0
+        # The download workers which are fed while crawling in --stream mode
+        self._pipeline = None
+        self._discovered = 0
+        # The output directory and the index of its files, set up on first use
+        self._output_dir = None
+        self._output_index = None
+        # Checkpoints the progress when the --state argument was passed
+        self._state = None
+        if self._args.state:
+            self._state = StateStore(self._args.state,
+                                     self._args.resume or self._args.sync)
+            if self._args.sync:
+                self._state.start_sync()
+        # The files collected so far, and with --seen the ones earlier runs
+        # downloaded
+        seen = None
+        if self._args.seen:
+            try:
+                seen = BloomFilter(self._args.seen, self._args.seen_capacity)
+            except(IOError, ValueError) as e:
+                stderr.write("Failed to load the --seen file ({0})\n".format(e))
+                stderr.flush()
+                exit(1)
+        self._index = MediaIndex(seen)
+        # The token of the session, and the sub-album API responses of the
+        # user whose links are extracted
+        self._token = None
+        self._sub_albums = {}
+        self._sub_albums_user = None
+        # The page fetchers which are shared by the albums of a recursive crawl
+        self._page_pool = None
+        # Set when the crawler threads should stop, e.g. after a Ctrl-C
+        self._stopping = threading.Event()
+        # Writes the downloaded files into archive volumes with --archive
+        self._archive = None
+        if self._args.archive and not self._args.links_only:
+            try:
+                self._archive = ArchiveSink.for_path(self._args.archive,
+                                                     self._args.archive_volume_size
+                                                     * 1024 * 1024)
+            except ValueError as e:
+                stderr.write("Invalid --archive ({0})\n".format(e))
+                stderr.flush()
+                exit(1)
+        # The digests of the downloaded files with --dedup, set up on first use
+        self._content_store = None
+        # Writes the links of the files with --links-only
+        self._exporter = None
+        if self._args.links_only:
+            path = self._args.links_file
+            if not path:
+                path = os.path.join(os.getcwd(), LINKS_FNAME[:-len(".txt")] +
+                                    LINKS_EXTENSIONS[self._args.links_format])
+            self._exporter = LinkExporter(path, self._args.links_format)
+        # Guards the counters and files which are shared by the download workers
+        self._lock = threading.Lock()
+        # Shared by all downloads to stay below the --max-rate
+        self._throttle = Throttle(self._args.max_rate * 1024)
+        self._writer = MediaWriter(self._args.chunk_size * 1024, self._args.preallocate,
+                                   self.profiler, self._throttle)
+        self._download_order = DownloadScheduler(self._args.order.split(","))
+        # The bytes and seconds spent on transfers, for the throughput summary
+        self._downloaded_bytes = 0
+        self._download_seconds = 0.0
 
     def _load_links(self):
-        """ Load the links which were passed with the args and return them. """
+        """ Yields the links which were passed with the args, the -f/--file is
+            read line by line. With --work-queue the lines of the file are
+            shared with the other processes which read it, with --shard only the
+            links which belong to this shard are yielded. """
         if(self._args.file):
             try: # Open the file the user passed with the -f/--file arg
-                with open(self._args.file) as f:
-                    links = [line.strip() for line in f.readlines() if line.strip()]
-            except(IOError):
+                if self._args.work_queue:
+                    lines = WorkQueue(self._args.file)
+                else:
+                    lines = open(self._args.file)
+            except(IOError, OSError):
                 stderr.write("Failed to open the specified file!\n")
-                stder.flush()
+                stderr.flush()
                 exit(1)
         else:
-            links = [u for u in self._args.urls if u.strip()]
-        return links
+            lines = self._args.urls
+        try:
+            for line in lines:
+                link = line.strip()
+                if link and self._in_shard(link):
+                    yield link
+        finally:
+            if self._args.file:
+                lines.close()
+
+    def _in_shard(self, link):
+        """ Returns whether the passed link belongs to the --shard of this
+            process. All links of a user belong to the same shard, so each
+            bucket is only extracted by one process. """
+        if not self._args.shard:
+            return True
+        shard, shards = self._args.shard
+        user = re.search("/user/([^/?#]+)", link)
+        key = user.group(1).lower() if user else _media_key(link)
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return int(hashlib.md5(key).hexdigest()[:8], 16) % shards == shard - 1
 
     def _get_password_from_url(self, url):
         """ Returns the password which is concatenated with the URL, as well as
@@ -96,47 +1924,217 @@ class Photobucket():
             return
         return link
 
-    def _extract_album(self, link, source):
-        """ Extracts the album pointed to by the passed link. """
+    def _get_album_page(self, link, page):
+        """ Fetches the passed page of the album and returns its image objects
+            together with the source, the image objects are None when the end of
+            the album has been reached. Raises IOError when the page couldn't be
+            fetched, which doesn't tell anything about the end of the album. """
+        url = "{0}{1}".format(link, page)
+        with self.profiler.span("pagination"):
+            source = self._get_source(url, True)
+        if source is None:
+            raise IOError("Couldn't connect to {0}".format(url))
+        if "End of album" in source:
+            return None, source
+        start = time.time()
+        with self.profiler.span("parse"):
+            image_links = self._album(source)
+        self.metrics.count("parse_seconds_total", time.time() - start)
+        if not image_links or image_links == "End of album":
+            return None, source
+        return image_links, source
+
+    def _get_page_count(self, source, page_size):
+        """ Returns the number of pages of the album by dividing the item count
+            from the 'albumJson' stats by the number of items on the first page,
+            None when the count can't be determined from the passed source. """
+        if not page_size or "var albumJson =" not in source:
+            return
+        try:
+            stats = self._get_album_stats(self._get_var_albumJson(source))
+            total = int(stats["Images"]) + int(stats["Videos"])
+        except(AttributeError, KeyError, TypeError, ValueError):
+            return
+        return max(1, -(-total // page_size))
+
+    def _prefetch_album_pages(self, link, pages):
+        """ Fetches the passed page numbers concurrently and returns a dictionary
+            which maps each page number to its image objects. The pages which
+            couldn't be fetched are left out. The albums of a recursive crawl
+            share one pool of -j/--jobs page fetchers, the other runs start a
+            pool for each window. """
+        fetched = {}
+        def fetch(page):
+            try:
+                fetched[page] = self._get_album_page(link, page)[0]
+            except IOError:
+                pass
+        if self._page_pool is None:
+            with WorkerPool(fetch, self._args.jobs) as pool:
+                for page in pages:
+                    if not pool.put(page):
+                        break
+            return fetched
+        done = Queue.Queue()
+        def job(page):
+            try:
+                if not self._stopping.is_set():
+                    fetch(page)
+            except Exception:
+                # Must not abort the pool of the other albums, the page is
+                # left out and fetched again by the album itself
+                pass
+            finally:
+                done.put(page)
+        queued = 0
+        for page in pages:
+            if not self._page_pool.put(lambda page=page: job(page)):
+                break
+            queued += 1
+        for _ in range(queued):
+            done.get()
+        return fetched
+
+    def _extract_album(self, link, first_page=None):
+        """ Extracts the album pointed to by the passed link. The first page
+            tells how many pages the album has, the remaining pages are then
+            fetched concurrently, a window of pages at a time. When the page
+            count is unknown (or wrong) the pages are walked one by one until
+            the end of the album. The first page is only fetched when the
+            result of _get_album_page for it isn't passed. When a page can't be
+            fetched the album is left unfinished at the last extracted page. """
         i = 1
         link = self._append_page_iter(link)
         collected_links = []
+        finished = False
         try:
             if not link:
                 raise ValueError
-            while 1: # Iterate over each album page and extract all images
-                source = self._get_source("{0}{1}".format(link, i), True)
-                if not source:
-                    break
-                elif "End of album" in source:
-                    break
-                image_links = self._album(source)
-                if not image_links or image_links == "End of album":
-                    break
-                collected_links.extend(image_links)
-                collected_links = list(set(collected_links))
-                stderr.write("\rCollected links: {0}".format(len(collected_links)))
+            # The last page which has been extracted by a previous run.
+            last_page = self._state.album_progress(link) if self._state else 0
+            if last_page is None:
+                stderr.write("Skipping already extracted album {0}\n".format(link))
+                stderr.flush()
+                return collected_links
+            try:
+                image_links, source = first_page or self._get_album_page(link, i)
+            except IOError:
+                # The link hasn't been fetched before, see extract
+                stderr.write("Couldn't connect to {0}\n".format(link))
                 stderr.flush()
+                return collected_links
+            if not image_links:
+                if self._is_unavailable(link, source):
+                    return collected_links
+                raise EOFError
+            if last_page < i:
+                if not self._collect(collected_links, image_links, link, i) and\
+                   self._args.sync:
+                    raise EOFError
+            elif last_page > i:
+                stderr.write("Resuming {0} at page {1}\n".format(link, last_page + 1))
+            i = max(i, last_page) + 1
+            # With --sync the pages are walked one by one, newest first, until a
+            # page without any new media shows up.
+            page_count = None
+            if not self._args.sync:
+                page_count = self._get_page_count(source, len(image_links))
+            window = self._args.jobs * 4
+            while page_count and i <= page_count:
+                pages = range(i, min(i + window, page_count + 1))
+                fetched = self._prefetch_album_pages(link, pages)
+                for page in pages:
+                    if page not in fetched:
+                        # Try a page which failed once more on its own, an
+                        # IOError leaves the album unfinished at this page.
+                        fetched[page] = self._get_album_page(link, page)[0]
+                    if not fetched[page]:
+                        # A page before the last one came back empty.
+                        raise EOFError
+                    self._collect(collected_links, fetched[page], link, page)
+                    i += 1
+            while 1: # Iterate over the remaining pages and extract all images
+                image_links, source = self._get_album_page(link, i)
+                if not image_links:
+                    break
+                new = self._collect(collected_links, image_links, link, i)
                 i += 1
+                if self._args.sync and not new:
+                    # The whole page is known, so are the older pages.
+                    break
+            finished = True
         except ValueError:
             stderr.write("Error: {0} appears to be an invalid link, skipping.\n".format(link))
             stderr.flush()
+        except EOFError:
+            finished = True
+        except IOError as e:
+            stderr.write("\n{0}, {1} pages of the album have been extracted\n".format(
+                         e, i - 1))
+            stderr.flush()
         except KeyboardInterrupt:
             pass
         finally:
+            if finished and self._state:
+                self._state.finish_album(link)
             stderr.write("\n")
             stderr.flush()
             return collected_links
 
+    def _collect(self, collected_links, image_links, album=None, page=None):
+        """ Hands the passed image objects straight to the download workers when
+            the --stream argument was passed, otherwise they're added to the
+            passed list of collected links. Image objects which have been
+            collected before are left out, with --state the others are
+            checkpointed and already downloaded ones are left out too. Returns
+            the number of image objects which haven't been seen by an earlier
+            run. """
+        if self._stopping.is_set():
+            raise KeyboardInterrupt
+        new = None
+        # Filtered before the checkpoint, which would keep the left out image
+        # objects pending for good
+        image_links = [image_link for image_link in image_links
+                       if self._index.add(image_link)]
+        if self._state:
+            image_links, new = self._state.add_page(album, page, image_links)
+        if new is None:
+            new = len(image_links)
+        if self._pipeline:
+            for image_link in image_links:
+                with self._lock:
+                    self._discovered += 1
+                # Blocks while the download queue is full.
+                if not self._pipeline.put(image_link):
+                    raise KeyboardInterrupt
+            return new
+        collected_links.extend(image_links)
+        stderr.write("\rCollected links: {0}".format(len(self._index)))
+        stderr.flush()
+        return new
+
     def _extract_image(self, link, source):
         """ Returns the direct link to the passed link. """
-        image_link = self._image(source)
+        with self.profiler.span("parse"):
+            image_link = self._image(source)
         if not image_link:
             stderr.write("\rFailed to obtain image from {0}!\n".format(link))
             stderr.flush()
             return
         return image_link
 
+    def _is_unavailable(self, link, source):
+        """ Returns bool when the passed source of an album can't be extracted,
+            because it is private, protected by a guest password or doesn't
+            exist, and prints why. """
+        if not source or source == "End of album":
+            return False
+        if self._is_guest_password_protected(source):
+            stderr.write("Error: No password for {0}\n".format(link))
+            stderr.flush()
+            return True
+        return self._has_invalid_message(source)
+
     def _has_invalid_message(self, source):
         """ Returns bool when the passed source contains strings which indicate
             that the album/library is private or that a page doesn't exist. """
@@ -154,20 +2152,43 @@ class Photobucket():
     def extract(self):
         """ Starts the whole extraction process. """
         collected_links = []
-        for link in self._load_links():
-            if not link or "photobucket.com" not in link:
-                continue
-            password, link = self._get_password_from_url(link)
-            source = self._get_source(link)
-            if not source:
-                stderr.write("Couldn't connect to {0}\n".format(link))
+        if self._state and (self._args.resume or self._args.sync):
+            # Pick up the files which a previous run found but didn't download.
+            pending = self._state.pending()
+            if pending:
+                stderr.write("Resuming {0} pending downloads\n".format(len(pending)))
                 stderr.flush()
-                continue
+                try:
+                    self._collect(collected_links, pending)
+                except KeyboardInterrupt:
+                    return collected_links
+        for link, password, extraction_type in self._plan_input():
+            if self._pipeline and self._pipeline.aborted.is_set():
+                break
+            if self._stopping.is_set():
+                # A recursive crawl has been interrupted
+                break
+            user = self._split_user_link(link)[0]
+            if user != self._sub_albums_user:
+                # The links are grouped per user, the responses of the previous
+                # user aren't asked for again
+                self._sub_albums.clear()
+                self._sub_albums_user = user
+            source = None
+            if extraction_type not in ("Album", "Bucket"):
+                # The type depends on the source, or the source is needed anyway
+                source = self._get_source(link)
+                if not source:
+                    stderr.write("Couldn't connect to {0}\n".format(link))
+                    stderr.flush()
+                    continue
             stderr.write("Processing: {0}\n".format(link))
             stderr.flush()
             try:
                 # Determine which extraction method to use for the current link
-                extraction_type = self._get_extraction_type(link, source)
+                if source is not None:
+                    with self.profiler.span("classification"):
+                        extraction_type = self._get_extraction_type(link, source)
                 # Albums, Guest password protected albums and buckets are mostly
                 # extracted the same with some few modifications in the routine
                 if(extraction_type in ("Album", "Gpwd album", "Bucket")):
@@ -182,9 +2203,11 @@ class Photobucket():
                     if self._args.recursive:
                         collected_links.extend(self._extract_recursive(link))
                     else:
-                        collected_links.extend(self._extract_album(link, source))
+                        collected_links.extend(self._extract_album(link))
                 elif extraction_type == "Image":
-                    collected_links.append(self._image(source))
+                    image_link = self._extract_image(link, source)
+                    if image_link:
+                        self._collect(collected_links, [image_link])
                 else:
                     if self._has_invalid_message(source):
                         continue
@@ -194,10 +2217,115 @@ class Photobucket():
                 stderr.write("\n")
                 stderr.flush()
 
-        collected_links = list(set(collected_links))
         self.collected_links.extend(collected_links)
         return collected_links
 
+    def _classify_link(self, url):
+        """ Returns the type of the passed url as far as it can be told without
+            its source, see _get_extraction_type. """
+        up = urlparse(url)
+        extraction_type = "Not supported"
+        if up.path.endswith("/library") or up.path.endswith("/library/"):
+            extraction_type = "Bucket"
+        elif "/library/" in up.path and not up.path.endswith("/library/"):
+            extraction_type = "Album"
+        elif "/images/" in up.path or "/videos/" in up.path:
+            extraction_type = "Album"
+        elif "/media/" in up.path:
+            extraction_type = "Image"
+        elif "@http://" in up.path:
+            extraction_type = "Gpwd album"
+        return extraction_type
+
+    def _plan_input(self, chunk_size=10000):
+        """ Yields the link, the guest password and the type of every input link
+            which has to be extracted, see _plan_links. The input is read and
+            planned in chunks of links, so a large input isn't held in memory;
+            duplicates and albums which are part of other albums are only found
+            within a chunk. With --work-queue each link is planned on its own,
+            the links are claimed one at a time. """
+        if self._args.work_queue:
+            chunk_size = 1
+        links = []
+        for link in self._load_links():
+            links.append(link)
+            if len(links) == chunk_size:
+                for planned in self._plan_links(links):
+                    yield planned
+                links = []
+        for planned in self._plan_links(links):
+            yield planned
+
+    def _plan_links(self, links):
+        """ Returns the link, the guest password and the type of the passed
+            links which have to be extracted, before anything is fetched. The
+            links are normalized to drop duplicates and classified by their URL,
+            their type is 'Unknown' when it depends on the source. With
+            -r/--recursive the albums and images which the crawl of another
+            album or bucket in the input turns up are dropped. The links are
+            grouped per user, the sub-album API responses are kept for the
+            links of one user. """
+        users = OrderedDict()
+        seen = set()
+        duplicates = covered = 0
+        for link in links:
+            if "photobucket.com" not in link:
+                continue
+            password, link = self._get_password_from_url(link)
+            user, kind, location = self._split_user_link(link)
+            key = (user, kind, location, password)
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            extraction_type = self._classify_link(link)
+            if password or extraction_type not in ("Album", "Bucket", "Image"):
+                extraction_type = "Unknown"
+            users.setdefault(user, []).append((link, password, extraction_type,
+                                               kind, location))
+        plan = []
+        for user, entries in users.items():
+            # The albums of the user which are extracted without a password
+            albums = set(location for _, password, extraction_type, kind, location
+                         in entries if user and kind == "library" and not password
+                         and extraction_type in ("Album", "Bucket"))
+            for link, password, extraction_type, kind, location in entries:
+                if user and not password and self._is_covered(kind, location, albums):
+                    covered += 1
+                    continue
+                plan.append((link, password, extraction_type))
+        if duplicates or covered:
+            stderr.write("Skipping {0} duplicate links and {1} links which are part of"
+                         " other albums\n".format(duplicates, covered))
+            stderr.flush()
+        return plan
+
+    def _split_user_link(self, link):
+        """ Returns the lower case user, 'library' or 'media' and the location of
+            the album (the file for 'media') of the passed link. The user is None
+            for other links, the whole normalized link is the location then. """
+        if isinstance(link, unicode):
+            link = link.encode("utf-8")
+        up = urlparse(link)
+        match = re.match("/user/([^/]+)/(library|media)(?:/(.*))?$", unquote(up.path))
+        if not match:
+            return None, None, up.netloc.lower() + unquote(up.path) + "?" + up.query
+        return match.group(1).lower(), match.group(2), (match.group(3) or "").strip("/")
+
+    def _is_covered(self, kind, location, albums):
+        """ Returns bool when the album or image at the passed location is part of
+            one of the passed album locations of the same user, '' is the bucket. """
+        if kind == "media":
+            location = location.rpartition("/")[0]
+            if location in albums:
+                return True
+        elif kind != "library":
+            return False
+        if not self._args.recursive:
+            return False
+        return any(album != location and (not album or location.startswith(album + "/"))
+                   for album in albums)
+
     def _get_extraction_type(self, url, source=""):
         """ Returns the passed url and source's type of image, the following
             return values are possible:
@@ -211,18 +2339,7 @@ class Photobucket():
             Image...........A single image (not direct link) on Photobucket.
             Not supported...Either the type couldn't be determined or it's not
                             supported. """
-        up = urlparse(url)
-        extraction_type = "Not supported"
-        if up.path.endswith("/library") or up.path.endswith("/library/"):
-            extraction_type = "Bucket"
-        elif "/library/" in up.path and not up.path.endswith("/library/"):
-            extraction_type = "Album"
-        elif "/images/" in up.path or "/videos/" in up.path:
-            extraction_type = "Album"
-        elif "/media/" in up.path:
-            extraction_type = "Image"
-        elif "@http://" in up.path:
-            extraction_type = "Gpwd album"
+        extraction_type = self._classify_link(url)
 
         if extraction_type == "Not supported":
             if "<h2>All Categories</h2>" in source:
@@ -242,7 +2359,10 @@ class Photobucket():
         """ Returns the output directory, either the pwd or the directory
             defined in the passed arguments.
             Subalbums are given a subdirectory to store their images in.
+            The directory is resolved and created only once per run.
         """
+        if self._output_dir:
+            return self._output_dir
         out = self._args.output_directory
         if not out:
             # Define the present working directory if it wasn't passed explicitly
@@ -261,8 +2381,8 @@ class Photobucket():
             try:
                 os.makedirs(out)
             except(OSError, IOError):
-                stderr.write("Failed to create output directory,",\
-                             "does it already exist?\n")
+                stderr.write("Failed to create output directory,"+\
+                             " does it already exist?\n")
                 stderr.flush()
                 exit(1)
 
@@ -272,96 +2392,374 @@ class Photobucket():
         # directory itself)
         if not out.endswith(os.sep):
             out += os.sep
+        self._output_dir = out
         return out
 
+    def _get_output_index(self):
+        """ Returns the index of the files in the output directory. """
+        if not self._output_index:
+            self._output_index = OutputIndex(self._get_output_dir())
+        return self._output_index
+
+    def _get_content_store(self):
+        """ Returns the content store of the output directory when --dedup was
+            passed, None otherwise. """
+        if not self._args.dedup:
+            return
+        with self._lock:
+            if not self._content_store:
+                path = self._args.dedup_index
+                if not path:
+                    path = os.path.join(self._get_output_dir(), "SHA256SUMS")
+                self._content_store = ContentStore(path, self._args.dedup)
+        return self._content_store
+
+    def _is_wanted(self, file_info):
+        """ Returns False when the type of the passed file is excluded with
+            --images-only or --videos-only. """
+        return not(self._args.images_only and file_info.mediaType.lower() == "video"
+                   or self._args.videos_only and file_info.mediaType.lower() == "image")
+
     def download_file(self, file_info):
         """ Downloads the file defined inside the passed fileinfo object. """
         # Skip certain file types when the arguments --images-only or videos-only
         # has been passed.
-        if(self._args.images_only and file_info.mediaType.lower() == "video"
-           or self._args.videos_only and file_info.mediaType.lower() == "image"):
+        if not self._is_wanted(file_info):
             return
 
         # Write url to a file if the --links-only parameter was passed.
         if(self._args.links_only):
-            print(file_info.link)
-            with open(os.path.join(os.getcwd(), LINKS_FNAME), 'a+') as f:
-                f.write(file_info.link + '\n')
+            self._exporter.write([file_info])
+            self._set_status(file_info, "done")
             return
 
-        out = self._get_output_dir()
+        if self._archive:
+            self._download_to_archive(file_info)
+            return
 
-        if not self._args.omit_existing:
-            # Make sure we don't overwrite any photos with the same name,
-            # we generate an unique filename in the format 'photo(1).jpg',
-            # 'photo(2).jpg' when the file already exists.
-            out = os.path.join(out, file_info.filename)
-            if os.path.isfile(out):
-                out = self._generate_unique_name(out)
-        else:
-            out += file_info.filename
-            files = [f for f in os.listdir(self._get_output_dir()) if f]
-            if file_info.filename in files:
-                msg = "\rSkipping download for already existing file: {0}\n"
-                stderr.write(msg.format(file_info.filename))
-                stderr.flush()
-                return
+        # Pick the file name while holding the lock, the other workers might be
+        # about to write a file with the same name.
+        with self._lock:
+            index = self._get_output_index()
+
+            if not self._args.omit_existing:
+                # Make sure we don't overwrite any photos with the same name,
+                # we generate an unique filename in the format 'photo(1).jpg',
+                # 'photo(2).jpg' when the file already exists.
+                out = os.path.join(index.path, index.unique_name(file_info.filename))
+            else:
+                out = os.path.join(index.path, file_info.filename)
+                if file_info.filename in index:
+                    msg = "\rSkipping download for already existing file: {0}\n"
+                    stderr.write(msg.format(file_info.filename))
+                    stderr.flush()
+                    self._set_status(file_info, "done")
+                    return
+                index.add(file_info.filename)
 
         # Fetch the url stored inside the fileinfo object and write the fetched
         # data into a file with the filename which is also stored inside the object.
+        # The data goes to a '.part' file first, which is renamed once it is
+        # complete, a partial file left by an earlier run is resumed.
+        part = self._get_part_name(out, file_info.link)
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        if self._args.preallocate:
+            # A preallocated partial file doesn't tell how much has been written.
+            offset = 0
+        store = self._get_content_store()
+        digest = hashlib.sha256() if store else None
         try:
-            with open(out, "wb") as f:
-                try:
-                    req = requests.get(file_info.link, stream=True)
-                    if req.status_code != requests.codes.ok:
-                        return
-                except requests.exceptions.RequestException:
-                    stderr.write("\rFailed to download {0}\n".format(file_info.link))
+            if not self._receive(file_info, part, offset, digest):
+                return
+            if store:
+                if not store.add(digest.hexdigest(), part, out):
+                    msg = "\rSkipping duplicate content of {0}\n"
+                    stderr.write(msg.format(file_info.link))
                     stderr.flush()
-                    return
-                for chunk in req.iter_content():
-                    if chunk:
-                        f.write(chunk)
-        except IOError as e:
+            else:
+                os.rename(part, out)
+        except(IOError, OSError) as e:
             stderr.write("\nFailed to save the downloaded file ({0})\n".format(e.strerror))
             stderr.flush()
             exit(1)
+        self._finish_download(file_info)
 
-        self._downloaded_images += 1
-
-    def _generate_unique_name(self, filename):
-        """ Handle duplicate file names. """
-        unique = 1
-        new_filename = filename
-        while os.path.isfile(new_filename):
-            # Store the file extension and add a number between the name and the
-            # extension, then rebuild the path and check if it exists, if it does
-            # the whole process is repeated until an unique file name was built.
-            file_extension = filename[filename.rindex("."):]
-            new_filename = "{0}({1}){2}".format(filename[:filename.rindex(".")],
-                                                unique,
-                                                file_extension)
-            if(not os.path.isfile(new_filename)):
-                return new_filename
-            unique += 1
+    def _download_to_archive(self, file_info):
+        """ Downloads the file defined inside the passed fileinfo object into
+            the --archive. The size of a member has to be known before it is
+            written, when the server sends it the file is written into the
+            volume as it is received, otherwise it is spooled first. """
+        spool = self._archive.spool()
+        streamed = []
+        def open_target(req, size):
+            if size is None or "Content-Encoding" in req.headers:
+                return spool
+            f = self._archive.open_member(file_info, size, req)
+            if f is None:
+                return spool
+            streamed.append(f)
+            return f
+        def done():
+            spool.close()
+            self._finish_download(file_info)
+        response = None
+        try:
+            try:
+                response = self._receive(file_info, open_target)
+            finally:
+                if streamed:
+                    self._archive.close_member(bool(response))
+            if not response:
+                spool.close()
+            elif streamed:
+                done()
+            else:
+                self._archive.add(file_info, spool, spool.tell(), response, done)
+        except(IOError, OSError) as e:
+            stderr.write("\nFailed to save the downloaded file ({0})\n".format(e.strerror))
+            stderr.flush()
+            exit(1)
+
+    def _receive(self, file_info, target, offset=0, digest=None):
+        """ Requests the file defined inside the passed fileinfo object, from the
+            passed offset on, and writes it to target, either the name of a file
+            which is appended to from the offset, a file object or a function
+            which returns the file object for the response and its size. The
+            whole file is added to the passed hashlib object. Returns the response
+            once the whole file has been received, True when there was nothing
+            left to receive and None when the download failed. """
+        try:
+            with self.profiler.span("request"):
+                req, offset = self._request_download(file_info.link, offset)
+            if digest and offset:
+                # Hash what an earlier run has received
+                with open(target, "rb") as f:
+                    self._writer.hash_file(f, offset, digest)
+            if req is None:
+                return True
+            if req.status_code not in (requests.codes.ok,
+                                       requests.codes.partial_content):
+                msg = "\rFailed to download {0} (status {1})\n"
+                stderr.write(msg.format(file_info.link, req.status_code))
+                stderr.flush()
+                self._set_status(file_info, "failed")
+                return
+            expected = req.headers.get("Content-Length", "")
+            size = int(expected) if expected.isdigit() else None
+            if isinstance(target, basestring):
+                with open(target, "ab" if offset else "wb") as f:
+                    with self.profiler.span("download"):
+                        written, seconds = self._writer.write(req, f, size, digest)
+            else:
+                if callable(target):
+                    target = target(req, size)
+                with self.profiler.span("download"):
+                    written, seconds = self._writer.write(req, target)
+            with self._lock:
+                self._downloaded_bytes += written
+                self._download_seconds += seconds
+            self.metrics.count("bytes_downloaded_total", written)
+            self.metrics.count("download_seconds_total", seconds)
+            written += offset
+            if(expected.isdigit() and "Content-Encoding" not in req.headers
+               and written != offset + int(expected)):
+                msg = "\rIncomplete download of {0} ({1} of {2} bytes)\n"
+                stderr.write(msg.format(file_info.link, written,
+                                        offset + int(expected)))
+                stderr.flush()
+                self._set_status(file_info, "failed")
+                return
+        except requests.exceptions.RequestException:
+            stderr.write("\rFailed to download {0}\n".format(file_info.link))
+            stderr.flush()
+            self._set_status(file_info, "failed")
+            return
+        return req
+
+    def _finish_download(self, file_info):
+        """ Counts the passed image object as downloaded. """
+        with self._lock:
+            self._downloaded_images += 1
+        self.metrics.count("files_downloaded_total")
+        self._set_status(file_info, "done")
+
+    def _get_part_name(self, out, link):
+        """ Returns the name of the file a download is written to until it is
+            complete. It contains a hash of the URL, so a partial file is only
+            ever resumed with the data of the same URL. """
+        digest = hashlib.sha1(link.encode("utf-8")).hexdigest()[:8]
+        return "{0}.{1}.part".format(out, digest)
+
+    def _request_download(self, link, offset=0):
+        """ Requests the passed link, with a Range header when a part of the file
+            has been downloaded already. Returns the response together with the
+            offset its body starts at, which is 0 when the server doesn't support
+            ranges. The response is None when there is nothing left to download. """
+        get = lambda **kwargs: self._scheduler.request(self._session, "GET", link,
+                                                       stream=True, **kwargs)
+        if not offset:
+            return get(), 0
+        req = get(headers={"Range": "bytes={0}-".format(offset)})
+        content_range = req.headers.get("Content-Range", "")
+        if req.status_code == requests.codes.partial_content:
+            match = re.match("bytes (\\d+)-", content_range)
+            if match and int(match.group(1)) == offset:
+                return req, offset
+        elif req.status_code == requests.codes.requested_range_not_satisfiable:
+            # The partial file is complete when its size equals the total size,
+            # which the server sends as 'bytes */<size>'.
+            total = content_range.rpartition("/")[2]
+            if total.isdigit() and int(total) == offset:
+                req.close()
+                return None, offset
+        else:
+            return req, 0
+        # Download the whole file again when the range doesn't fit.
+        req.close()
+        return get(), 0
+
+    def _set_status(self, file_info, status):
+        """ Checkpoints the download status of the passed file with --state and
+            remembers downloaded files with --seen. """
+        self._set_statuses([file_info], status)
+
+    def _set_statuses(self, file_infos, status):
+        """ Checkpoints the download status of the passed files at once, see
+            _set_status. """
+        if self._state:
+            self._state.set_statuses([file_info.link for file_info in file_infos],
+                                     status)
+        if status == "done":
+            for file_info in file_infos:
+                self._index.done(file_info)
+
+    def close(self):
+        """ Releases the resources which are held for the run. """
+        if self._stats_writer:
+            self._stats_writer.stop()
+        self.profiler.dump()
+        self._index.close()
+        self._save_session()
+        if self._archive:
+            self._archive.close()
+        if self._content_store:
+            self._content_store.close()
+        if self._exporter:
+            self._exporter.close()
+        if self._state:
+            self._state.close()
+
+    def _download_worker(self, file_obj):
+        """ Downloads a single file on one of the worker threads and updates the
+            progress line. """
+        self.download_file(file_obj)
+        if (not self._args.links_only): # don't display progress bar for just urls
+            with self._lock:
+                self._log_download_status()
 
     def download_all_images(self):
-        """ Downlods all collected images. """
+        """ Downlods all collected images, the -j/--jobs argument defines how
+            many files are downloaded in parallel. """
+        if self._args.links_only:
+            self._export_links()
+            return
+        try:
+            file_infos = self._order_downloads(self.collected_links)
+        except(KeyboardInterrupt, EOFError):
+            return
         self._log_download_status()
-        for file_obj in self.collected_links:
-            try:
-                self.download_file(file_obj)
-            except(KeyboardInterrupt, EOFError):
-                break
-            else:
-                if (not self._args.links_only): # don't display progress bar for just urls
-                    self._log_download_status
-                
+        try:
+            with WorkerPool(self._download_worker, self._args.jobs) as pool:
+                self.metrics.gauge("download_queue_depth", pool.qsize)
+                for file_obj in file_infos:
+                    if not pool.put(file_obj):
+                        break
+        except(KeyboardInterrupt, EOFError):
+            pass
+        self._log_download_summary()
+
+    def _order_downloads(self, file_infos):
+        """ Returns the passed image objects in the order of the --order
+            policies. The sizes of the files are requested in parallel when
+            they're needed. """
+        sizes = None
+        if self._download_order.needs_sizes:
+            file_infos = [file_info for file_info in file_infos
+                          if self._is_wanted(file_info)]
+            stderr.write("Requesting the sizes of {0} files\n".format(len(file_infos)))
+            stderr.flush()
+            sizes = {}
+            def get_size(file_info):
+                sizes[file_info.link] = self._get_file_size(file_info.link)
+            with WorkerPool(get_size, self._args.jobs) as pool:
+                for file_info in file_infos:
+                    if not pool.put(file_info):
+                        break
+        return self._download_order.order(file_infos, sizes)
+
+    def _get_file_size(self, link):
+        """ Returns the size of the passed file from a HEAD request, None when
+            the server doesn't tell it. """
+        try:
+            req = self._scheduler.request(self._session, "HEAD", link, timeout=20,
+                                          allow_redirects=True)
+        except requests.exceptions.RequestException:
+            return
+        length = req.headers.get("Content-Length", "")
+        if req.status_code != requests.codes.ok or not length.isdigit():
+            return
+        return int(length)
+
+    def _export_links(self, batch_size=10000):
+        """ Writes the links of all collected images with --links-only, there is
+            nothing to download so they're written in large batches. """
+        file_infos = []
+        for file_info in self.collected_links:
+            if not self._is_wanted(file_info):
+                continue
+            file_infos.append(file_info)
+            if len(file_infos) == batch_size:
+                self._write_links(file_infos)
+                file_infos = []
+        self._write_links(file_infos)
+
+    def _write_links(self, file_infos):
+        """ Exports the passed image objects and marks them as done. """
+        if not file_infos:
+            return
+        self._exporter.write(file_infos)
+        self._set_statuses(file_infos, "done")
+
+    def stream_all_images(self):
+        """ Extracts and downloads at the same time, each image is handed to the
+            download workers as soon as it has been found. The queue in front of
+            the workers is bounded, so the crawler waits for the downloads and
+            doesn't hold more than a few images in memory. """
+        self._log_download_status()
+        try:
+            with WorkerPool(self._download_worker, self._args.jobs) as pool:
+                self.metrics.gauge("download_queue_depth", pool.qsize)
+                self._pipeline = pool
+                self.extract()
+        except(KeyboardInterrupt, EOFError):
+            pass
+        finally:
+            self._pipeline = None
+        self._log_download_summary()
+
+    def _log_download_summary(self):
+        """ Prints the final download status after all downloads are done. """
         if (not self._args.links_only): # don't display progress bar for just urls
             stderr.write("\r                                             ")
             stderr.write("\n")
             self._log_download_status()
             stderr.write("\n")
+            if self._downloaded_bytes:
+                # The throughput of a single transfer, averaged over all files.
+                megabytes = self._downloaded_bytes / (1024.0 * 1024.0)
+                rate = megabytes / max(self._download_seconds, 0.001)
+                stderr.write("Transferred {0:.1f} MB, {1:.2f} MB/s per transfer\n".format(
+                             megabytes, rate))
             stderr.flush()
 
     def display_image_urls(self):
@@ -374,29 +2772,79 @@ class Photobucket():
     def _log_download_status(self):
         """ Prints the number of downloaded images and the total of images collected
             to stderr. """
-        stderr.write("\rDownloaded files: {0}/{1}".format(self._downloaded_images,
-                                                          len(self.collected_links)))
+        # The total isn't known up front in --stream mode, use the number of
+        # images which have been found so far instead.
+        total = self._discovered if self._args.stream else len(self.collected_links)
+        stderr.write("\rDownloaded files: {0}/{1}".format(self._downloaded_images, total))
         stderr.flush()
 
     def _configure_session(self):
         """ Assignes the default headers to the session and obtains the session
             cookie when account credentials have been declared. """
         headers = {"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64;"+\
-                                 " rv:29.0) Gecko/20100101 Firefox/29.0",
-                   "Connection": "close"}
+                                 " rv:29.0) Gecko/20100101 Firefox/29.0"}
         self._session.headers.update(headers)
+        self._configure_pools()
+        # Reuse the cookies of an earlier run with --session-file
+        if self._sessions and self._sessions.load(self._session, self._args.username):
+            self._authenticated = "pbauth" in self._session.cookies
         # Try to authenticate
         if self._args.username and self._args.password:
          source = self._get_source("http://photobucket.com/")
-         if source:
+         if source and self._authenticated and not self._is_logged_in(source):
+             # The server has dropped the stored session before it expired
+             stderr.write("The stored session is no longer valid, logging in again.\n")
+             stderr.flush()
+             self._drop_auth_cookies()
+             self._authenticated = False
+             source = self._get_source("http://photobucket.com/")
+         if source and not self._authenticated:
              token = self._get_token(source)
              if token:
-                 self._login(self._args.username, self._args.password, token)
+                 if self._login(self._args.username, self._args.password, token):
+                     self._save_session(renewed=True)
+
+    def _configure_pools(self):
+        """ Mounts the connection pools of the session. Connections are kept
+            alive and reused by all threads, each host gets a pool of --pool-size
+            connections (at least one per job) unless a different size has been
+            set for it with --pool HOST=SIZE. Retries are left to the request
+            scheduler. """
+        size = max(self._args.pool_size or 0, self._args.jobs)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self._args.pool_hosts,
+                                                pool_maxsize=size, max_retries=0)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        for host_size in self._args.pool or []:
+            host, _, size = host_size.rpartition("=")
+            if not host or not size.isdigit():
+                stderr.write("Ignoring invalid pool size {0}\n".format(host_size))
+                stderr.flush()
+                continue
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=int(size),
+                                                    max_retries=0)
+            self._session.mount("http://{0}".format(host), adapter)
+            self._session.mount("https://{0}".format(host), adapter)
+
+    def _get(self, url, cache_key=None, **kwargs):
+        """ Makes a GET request of the crawl through the request scheduler, and
+            through the response cache when the --cache-dir argument was passed. """
+        if self._cache:
+            return self._cache.get(self._fetch, url, cache_key, **kwargs)
+        return self._fetch(url, **kwargs)
+
+    def _fetch(self, url, **kwargs):
+        """ Makes a GET request with the session through the request scheduler. """
+        return self._scheduler.request(self._session, "GET", url, **kwargs)
 
     def _get_source(self, url, check_for_eof=False):
         """ Returns the passed url's source code. """
+        start = time.time()
         try: # Make the request with the passed url
-            req = self._session.get(url, timeout=20)
+            req = self._get(url, timeout=20)
+            self.metrics.count("pages_fetched_total")
+            self.metrics.observe("page_fetch_seconds", time.time() - start)
             if req.status_code != requests.codes.ok:
                 raise requests.exceptions.RequestException
             if check_for_eof and "page=" not in req.url:
@@ -405,16 +2853,11 @@ class Photobucket():
             return
         except(EOFError):
             return "End of album"
-        return req.content
+        return Page(req.content)
 
     def _get_token(self, source):
         """ Returns the token of the passed source. """
-        try:
-            soup = BeautifulSoup(source)
-            token = soup.find(id="token")["value"]
-        except(TypeError, KeyError):
-            return
-        return token
+        return Page.of(source).token
 
     def _image(self, source):
         """ Returns the an ImageInfo object when the passed source contains the
@@ -440,13 +2883,15 @@ class Photobucket():
         """ Returns the 'var albumJson' json data from the passed source, this
             blob of data contains various library(Bucket) information. """
         assert "var albumJson =" in source
-        data = re.search("var albumJson.*\n", source)
-        data = data.group().replace("var albumJson = ", "").strip()[:-1]
-        return json.loads(data)
+        return Page.of(source).album_json
 
     def _get_sub_albums(self, source, album_name="Library"):
-        """ Returns a list of sub-albums of the passed source. """
-        token = self._get_token(source)
+        """ Returns a list of sub-albums of the passed source. The responses are
+            kept while the links of the user are extracted, an album which is
+            reached through several of them is only requested once. """
+        # The token is the same for all pages of the session
+        token = self._get_token(source) or self._token
+        self._token = token
         library_info = self._get_var_albumJson(source)
         username = library_info.get("ownername")
 
@@ -458,30 +2903,28 @@ class Photobucket():
         api_url = "http://photobucket.com/api/user/{0}/album/".format(username)
         if album_name != "Library":
             api_url += "{}/".format(album_name)
-        api_url += "get?subAlbums=8&json=1&hash={}".format(token)
-        # Make the request with the new assembled URL
-        req = self._session.get(api_url)
-        if req.status_code != requests.codes.ok:
-            return
-        try:
-            return req.json()
-        except ValueError:
-            return
+        api_url += "get?subAlbums=8&json=1"
+        # Make the request with the new assembled URL, the token changes with
+        # every session and is left out of the cache key.
+        if api_url in self._sub_albums:
+            return self._sub_albums[api_url]
+        with self.profiler.span("sub-album API"):
+            req = self._get(api_url + "&hash={}".format(token), cache_key=api_url)
+            if req.status_code != requests.codes.ok:
+                return
+            try:
+                self._sub_albums[api_url] = req.json()
+            except ValueError:
+                return
+        return self._sub_albums[api_url]
 
     def _get_var_collectionData(self, source, collectionId="libraryAlbums"):
         """ Extracts the 'collectionData' json data from the passed source and
             returns it. """
         assert "collectionData:" in source
-        soup = BeautifulSoup(source)
-        data = None
-        for blob in soup.find_all("script"):
-            if "collectionId: '{0}'".format(collectionId) in blob.text:
-                data = re.search("collectionData:.*?\n", blob.text).group().strip()
-                data = data.replace("collectionData: ", "").strip()
-                if(data.endswith("},")):
-                    data = data[:-1]
+        data = Page.of(source).collection_data(collectionId)
         assert bool(data)
-        return json.loads(data)
+        return data
 
     def _album(self, source):
         """ Returns a list of image files from the passed source on success. """
@@ -497,7 +2940,8 @@ class Photobucket():
             images = j.get("items").get("objects")
             if not images:
                 raise EOFError
-        except(EOFError):
+        except(EOFError, AssertionError):
+            # No collection data, e.g. the album is private or protected
             return "End of album"
         # Try to detect the first page and print the estimated file count
         # to stderr.
@@ -506,13 +2950,10 @@ class Photobucket():
             stderr.flush()
         image_objects = []
         for obj in images:
-            new_link = obj.get("fullsizeUrl")
-            up = urlparse(new_link)
-            new_link = "{0}~original".format(up.geturl())
-            obj["originalUrl"] = new_link
+            if not obj:
+                continue
+            obj["originalUrl"] = urlparse(obj.get("fullsizeUrl")).geturl()
             image_objects.append(ImageInfo(obj["name"], **obj))
-
-        image_objects = [ImageInfo(obj["name"], **obj) for obj in images if obj]
         return image_objects
 
     def _get_album_stats(self, json_data):
@@ -532,48 +2973,126 @@ class Photobucket():
             return
         album_json = self._get_var_albumJson(source)
         stats = self._get_album_stats(album_json)
-        for k, v in stats.items():
-            stderr.write("{0}: {1}\n".format(k, v))
-        stderr.write("\n")
+        # Written at once, the albums of a recursive run are extracted in parallel
+        stderr.write("".join("{0}: {1}\n".format(k, v) for k, v in stats.items()) + "\n")
         stderr.flush()
 
     def _extract_recursive(self, start_url):
         """ Recursively extracts all images and videos from the passed start URL,
             this means that each sub-album in albums is visited, as well as their
-            sub-sub-albums until sub-sub-ception is reached. """
-        unvisited = [start_url]
-        visited = []
+            sub-sub-albums until sub-sub-ception is reached. Up to -j/--jobs
+            albums are extracted in parallel, the sub-albums they turn up are
+            queued in the frontier until a worker is free. """
+        frontier = deque([start_url])
+        visited = set()
         collected_links = []
+        results = Queue.Queue()
+        def crawl(url):
+            image_links, sub_albums = [], []
+            try:
+                image_links, sub_albums = self._extract_tree_album(url)
+            except Exception as e:
+                stderr.write("\nFailed to extract {0} ({1})\n".format(url, e))
+                stderr.flush()
+            finally:
+                results.put((image_links, sub_albums))
         try:
-            while unvisited:
-                # Pop an URL from the unvisited list
-                url = unvisited.pop()
-                if url in visited:
-                    continue
-                # Get the images of the current URL
-                source = self._get_source(url)
-                collected_links.extend(self._extract_album(url, source))
-                album_json = self._get_var_albumJson(source)
-                if album_json.get("isRootAlbum"):
-                    album_info = self._get_sub_albums(source)
-                else:
-                    album_info = self._get_sub_albums(source, album_json.get("location"))
-
-                # Print the album stats for the current URL
-                self._print_album_stats(self._get_album_stats(album_json))
-                # Add sub-album links to the unvisited list when there are any
-                if album_info.get("data").get("subAlbumCount") > 0:
-                    for album in album_info.get("data").get("subAlbums"):
-                        unvisited.append(album.get("url")+"?sort=3&page=")
-                visited.append(url)
+            with WorkerPool(lambda job: job(), self._args.jobs) as self._page_pool:
+                with WorkerPool(crawl, self._args.jobs) as pool:
+                    try:
+                        self._crawl(pool, frontier, visited, results, collected_links)
+                    except KeyboardInterrupt:
+                        # Stop the albums in flight before the pools wait for them
+                        self._stopping.set()
+                        raise
         except KeyboardInterrupt:
-            pass
+            self._stopping.set()
         finally:
+            self._page_pool = None
+            # Keep what the albums which were in flight found before they stopped
+            while not results.empty():
+                collected_links.extend(results.get()[0])
             return collected_links
 
+    def _crawl(self, pool, frontier, visited, results, collected_links):
+        """ Hands the albums of the frontier to the crawler pool, up to -j/--jobs
+            at a time, and adds the image objects and sub-albums they turn up
+            to the passed list and the frontier until the tree is done. """
+        in_flight = 0
+        while frontier or in_flight:
+            while frontier and in_flight < self._args.jobs:
+                url = frontier.popleft()
+                key = self._append_page_iter(url)
+                if key in visited:
+                    continue
+                visited.add(key)
+                if not pool.put(url):
+                    raise KeyboardInterrupt
+                in_flight += 1
+            if not in_flight:
+                break
+            try: # Use a timeout so that a KeyboardInterrupt isn't swallowed
+                image_links, sub_albums = results.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            in_flight -= 1
+            collected_links.extend(image_links)
+            frontier.extend(sub_albums)
+
+    def _extract_tree_album(self, url):
+        """ Extracts a single album of a recursive run and returns its image
+            objects and the links to its sub-albums. The first page of the album
+            is fetched once, for its stats, its media and its sub-albums. """
+        link = self._append_page_iter(url)
+        sub_albums = None
+        if self._state and link:
+            sub_albums = self._state.sub_albums(link)
+        if sub_albums is not None:
+            # A previous run got through this album, continue with the
+            # sub-albums it found.
+            return self._extract_album(url), sub_albums
+        first_page = None
+        if link:
+            try:
+                first_page = self._get_album_page(link, 1)
+            except IOError:
+                # Left to _extract_album, which reports it
+                pass
+        image_links = self._extract_album(url, first_page)
+        source = first_page[1] if first_page else None
+        if not source or "var albumJson =" not in source:
+            return image_links, []
+        album_json = self._get_var_albumJson(source)
+        if album_json.get("isRootAlbum"):
+            album_info = self._get_sub_albums(source)
+        else:
+            album_info = self._get_sub_albums(source, album_json.get("location"))
+        # Add sub-album links to the frontier when there are any
+        sub_albums = []
+        data = (album_info or {}).get("data") or {}
+        if data.get("subAlbumCount") > 0:
+            for album in data.get("subAlbums"):
+                sub_albums.append(album.get("url")+"?sort=3&page=")
+        if self._state and album_info:
+            self._state.add_sub_albums(link, sub_albums)
+        return image_links, sub_albums
+
+    def _save_session(self, renewed=False):
+        """ Writes the cookies of the session to the --session-file, renewed
+            means that they have just been obtained by logging in. """
+        if not self._sessions:
+            return
+        if renewed:
+            self._sessions.since = None
+        try:
+            self._sessions.save(self._session, self._args.username)
+        except(IOError, OSError) as e:
+            stderr.write("Failed to save the session ({0})\n".format(e))
+            stderr.flush()
+
     def _login(self, username, password, token):
         """ Tries to authenticate with the Photubucket servers. """
-        post_url = "https://secure.photobucket.com/action/auth/login"
+        post_url = LOGIN_URL
         post_data = {"hash": token, "returnUrl": "", "username": username,
                      "password": password}
         try:
@@ -586,15 +3105,31 @@ class Photobucket():
             stderr.flush()
         return "pbauth" in self._session.cookies
 
+    def _is_logged_in(self, source):
+        """ Returns bool when the passed source has been served to the logged in
+            user. A server which doesn't accept the auth cookie removes it or
+            shows the login form again. """
+        if "pbauth" not in self._session.cookies:
+            return False
+        for form in Page.of(source).soup.find_all("form", action=True):
+            if urlparse(form["action"]).path == urlparse(LOGIN_URL).path:
+                return False
+        return True
+
+    def _drop_auth_cookies(self):
+        """ Removes the auth cookies of the account from the session, the cookies
+            of guest password protected albums are kept. """
+        for cookie in list(self._session.cookies):
+            if cookie.name == "pbauth":
+                self._session.cookies.clear(cookie.domain, cookie.path, cookie.name)
+
     def _is_private_album(self, source):
         """ Returns bool if the passed source's album is private. """
         return "This album is Private." in source
 
     def _is_guest_password_protected(self, source):
         """ Returns bool if the passed source has the guest password input element. """
-        soup = BeautifulSoup(source)
-        identifier = soup.find("form", id="guestLoginForm")
-        return bool(identifier)
+        return bool(Page.of(source).guest_form)
 
     def _enter_guest_password(self, url, source, password):
         """ Tries to authenticate with a passed guest password to be able to
@@ -620,12 +3155,12 @@ class Photobucket():
         post_data = {"albumPath": "", "albumType": "", "albumView": "",
                      "hash": "", "visitorPassword": password}
         try: # Fill up the post_data dictionary with the required values
-            soup = BeautifulSoup(source)
-            form = soup.find(id="guestLoginForm")
+            page = Page.of(source)
+            form = page.guest_form
             post_data["albumPath"] = form.find_all("input")[0]["value"]
             post_data["albumType"] = form.find_all("input")[1]["value"]
             post_data["albumView"] = form.find_all("input")[2]["value"]
-            post_data["hash"] = self._get_token(source)
+            post_data["hash"] = page.token
             post_url = urljoin(url, form["action"])
         except(AttributeError, IndexError):
             stderr.write("Failed to authenticate\n")
@@ -643,10 +3178,12 @@ class Photobucket():
             stderr.write(e.message)
             stderr.flush()
             return
-        return req.content
+        self._save_session()
+        return Page(req.content)
 
 
-if __name__ == "__main__":
+def build_parser():
+    """ Returns the parser of the command line arguments. """
     parser = argparse.ArgumentParser()
     parser.add_argument("-r", "--recursive",
                         help="Recursively extracts images and videos from all"+\
@@ -656,7 +3193,121 @@ if __name__ == "__main__":
                         help="The directory the extracted images getting saved in.",
                         required=False)
     parser.add_argument("--omit-existing", action="store_true", required=False)
+    parser.add_argument("-j", "--jobs",
+                        help="The number of album pages and files which are"+\
+                             " fetched in parallel.",
+                        type=int, default=1)
     parser.add_argument("-v", "--verbose", required=False)
+    parser.add_argument("--rate",
+                        help="The maximum number of requests per second to a"+\
+                             " single host, 0 means no limit. (default: 0)",
+                        type=float, default=0)
+    parser.add_argument("--retries",
+                        help="How often failed requests are retried. (default: 5)",
+                        type=int, default=5)
+    parser.add_argument("--pool-size",
+                        help="The number of connections which are kept open to"+\
+                             " each host. (default: the number of --jobs)",
+                        type=int)
+    parser.add_argument("--pool-hosts",
+                        help="The number of hosts to which connections are kept"+\
+                             " open. (default: 32)",
+                        type=int, default=32)
+    parser.add_argument("--pool",
+                        help="The number of connections which are kept open to"+\
+                             " a specific host, e.g. i.photobucket.com=16, can"+\
+                             " be passed more than once.",
+                        metavar="HOST=SIZE", action="append")
+    parser.add_argument("--max-rate",
+                        help="The maximum number of KiB per second all downloads"+\
+                             " together may transfer, 0 means no limit. (default: 0)",
+                        type=int, default=0)
+    parser.add_argument("--order",
+                        help="The order of the downloads, a comma separated list of"+\
+                             " 'images-first', 'smallest' (sizes requested with"+\
+                             " HEAD), 'round-robin' (albums take turns) or 'found'."+\
+                             " Not used with --stream. (default: found)",
+                        default="found")
+    parser.add_argument("--chunk-size",
+                        help="The size in KiB of the chunks in which files are"+\
+                             " downloaded and written. (default: 64)",
+                        type=int, default=64)
+    parser.add_argument("--preallocate",
+                        help="Reserve the full size of each file before writing"+\
+                             " it, partial downloads can't be resumed then.",
+                        action="store_true")
+    parser.add_argument("--archive",
+                        help="Write the downloaded files into an archive instead of"+\
+                             " separate files, a .tar, .zip, .warc or .warc.gz file."+\
+                             " The members are listed in <name>.index.jsonl.")
+    parser.add_argument("--archive-volume-size",
+                        help="Start a new volume of the --archive once it holds"+\
+                             " this many MB, 0 means no limit. (default: 0)",
+                        type=int, default=0)
+    parser.add_argument("--dedup", choices=ContentStore.MODES,
+                        help="Hash the downloaded files and hardlink a file to the"+\
+                             " earlier file with the same content, or don't keep it"+\
+                             " with 'skip'. The SHA-256 digests are kept in"+\
+                             " SHA256SUMS in the output directory.")
+    parser.add_argument("--dedup-index",
+                        help="The SHA256SUMS file of --dedup, another output"+\
+                             " directory can share the digests this way.")
+    parser.add_argument("--cache-dir",
+                        help="A directory in which the album pages are cached,"+\
+                             " unchanged pages aren't downloaded again.")
+    parser.add_argument("--cache-size",
+                        help="The maximum size of the --cache-dir in MB."+\
+                             " (default: 256)",
+                        type=int, default=256)
+    parser.add_argument("--stats-file",
+                        help="A file to which the metrics of the run are written"+\
+                             " periodically.")
+    parser.add_argument("--stats-format",
+                        help="The format of the --stats-file, 'prometheus' for"+\
+                             " the textfile collector. (default: json, or"+\
+                             " prometheus for *.prom files)",
+                        choices=("json", "prometheus"))
+    parser.add_argument("--stats-interval",
+                        help="The seconds between writes of the --stats-file."+\
+                             " (default: 10)",
+                        type=float, default=10)
+    parser.add_argument("--profile",
+                        help="Profile the run and write the cProfile statistics"+\
+                             " to the passed file, the time spent in each stage"+\
+                             " is printed at the end.")
+    parser.add_argument("--state",
+                        help="A SQLite file in which the progress of the run is"+\
+                             " recorded, see --resume.")
+    parser.add_argument("--resume",
+                        help="Continue the run which was recorded in the --state"+\
+                             " file where it stopped.",
+                        action="store_true")
+    parser.add_argument("--sync",
+                        help="Only download the media which has been added since"+\
+                             " the last run with the same --state file, albums"+\
+                             " are only walked until a page without new media.",
+                        action="store_true")
+    parser.add_argument("--seen",
+                        help="A file in which the downloaded files are remembered"+\
+                             " across runs, files found in it are skipped.")
+    parser.add_argument("--seen-capacity", type=int, default=1000000,
+                        help="The number of files the --seen file is sized for when"+\
+                             " it is created, more files raise the chance that a new"+\
+                             " file is taken for a known one. (default: 1000000)")
+    parser.add_argument("--shard",
+                        help="Only extract the links of the K-th of N shards of the"+\
+                             " input, e.g. 2/4. The links of a user always belong to"+\
+                             " the same shard, so N processes or machines can split"+\
+                             " one input without overlap.", metavar="K/N")
+    parser.add_argument("--work-queue",
+                        help="Share the -f/--file with the other processes on this"+\
+                             " machine which read it with --work-queue, each link"+\
+                             " is extracted by one of them. The progress is kept in"+\
+                             " <file>.offset.", action="store_true")
+    parser.add_argument("--stream",
+                        help="Start downloading while the albums are still being"+\
+                             " extracted instead of extracting everything first.",
+                        action="store_true")
 
     input_group = parser.add_mutually_exclusive_group(required=True)
     input_group.add_argument("-f", "--file",
@@ -666,6 +3317,10 @@ if __name__ == "__main__":
                              help="One or more links which point to an album or"+\
                                   " image which is hosted on Photobucket.",
                              nargs="+")
+    input_group.add_argument("--merge-state",
+                             help="Merge the passed state files, e.g. of the shards"+\
+                                  " of a run, into the --state file and exit.",
+                             nargs="+", metavar="STATE")
 
     type_group = parser.add_mutually_exclusive_group(required=False)
     type_group.add_argument("--images-only",
@@ -678,15 +3333,32 @@ if __name__ == "__main__":
                         help="Only store the links to the images in a text file: links-<datetime>.txt.",
                         action="store_true")
 
+    parser.add_argument("--links-format", choices=LinkExporter.FORMATS,
+                        default="urls",
+                        help="The format of the --links-only file, 'aria2' for"+\
+                             " the input file of aria2c, 'jsonl' for one JSON"+\
+                             " object with the information about each file per"+\
+                             " line. (default: urls)")
+    parser.add_argument("--links-file",
+                        help="The file the --links-only links are written to, '-'"+\
+                             " for stdout. (default: links-<datetime>.txt)")
+
     auth_grp = parser.add_argument_group("Authentication")
     auth_grp.add_argument("-n", "--username",
                           help="The username or email which is used to authenticate"+\
                                " with Photobucket.")
     auth_grp.add_argument("-p", "--password",
                           help="The matching password for your account. ")
+    auth_grp.add_argument("--session-file",
+                          help="A file in which the cookies of the login and of"+\
+                               " guest password protected albums are kept, later"+\
+                               " runs reuse them until they expire.")
 
+    return parser
 
 
+if __name__ == "__main__":
+    parser = build_parser()
     args = parser.parse_args()
 
     # When the username has been passed the password must be set aswell
@@ -696,7 +3368,57 @@ if __name__ == "__main__":
         stderr.flush()
         exit(1)
 
+    if (args.resume or args.sync) and not args.state:
+        stderr.write("The --resume and --sync arguments require a --state file.\n")
+        stderr.flush()
+        exit(1)
+
+    if args.merge_state:
+        if not args.state:
+            stderr.write("The --merge-state argument requires a --state file.\n")
+            stderr.flush()
+            exit(1)
+        state = StateStore(args.state, True)
+        for path in args.merge_state:
+            try:
+                state.merge(path)
+            except sqlite3.Error as e:
+                stderr.write("Failed to merge {0} ({1})\n".format(path, e))
+                stderr.flush()
+                exit(1)
+            stderr.write("Merged {0}\n".format(path))
+        state.close()
+        exit(0)
+
+    if args.shard:
+        shard, _, shards = args.shard.partition("/")
+        if not shard.isdigit() or not shards.isdigit() or not 0 < int(shard) <= int(shards):
+            stderr.write("The --shard argument has to be K/N with 1 <= K <= N.\n")
+            stderr.flush()
+            exit(1)
+        args.shard = int(shard), int(shards)
+
+    unknown = set(args.order.split(",")) - set(DownloadScheduler.POLICIES)
+    if unknown:
+        stderr.write("Unknown --order policies: {0}\n".format(", ".join(sorted(unknown))))
+        stderr.flush()
+        exit(1)
+
+    if args.dedup and args.archive:
+        stderr.write("The --dedup argument can't be used with --archive.\n")
+        stderr.flush()
+        exit(1)
+
+    if args.work_queue and not args.file:
+        stderr.write("The --work-queue argument requires a -f/--file.\n")
+        stderr.flush()
+        exit(1)
+
     pb = Photobucket(args)
-    pb.extract()
-    pb.download_all_images()
+    if args.stream:
+        pb.stream_all_images()
+    else:
+        pb.extract()
+        pb.download_all_images()
+    pb.close()
 